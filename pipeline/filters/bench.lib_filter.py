@@ -0,0 +1,187 @@
+""" Benchmarks for the lib_filter classes and functions. These are not tests,
+run them by hand when working on the performance of lib_filter, e.g.
+  python bench.lib_filter.py --benchmark fastaParsing --size 200
+"""
+from argparse import ArgumentParser
+import copy
+import imp
+import os
+import random
+import shutil
+import tempfile
+import time
+import lib_filter
+indel = imp.load_source(
+  'indel', os.path.join(os.path.abspath(os.path.dirname(__file__)), 'indel'))
+
+
+def syntheticFasta(path, numChroms, chromLength, lineLength=60, seed=0):
+  """ write a multi-chromosome fasta of random, soft-masked sequence with
+  N runs to PATH. Returns the size of the file in bytes.
+  """
+  rand = random.Random(seed)
+  bases = 'ACGTacgt'
+  with open(path, 'w') as f:
+    for c in xrange(numChroms):
+      f.write('>chr%d synthetic\n' % c)
+      # build the chromosome from a pool of random lines to keep this fast
+      pool = [''.join(rand.choice(bases) for i in xrange(lineLength))
+              for j in xrange(64)]
+      pool.append('N' * lineLength)
+      lines = [rand.choice(pool) for i in xrange(chromLength // lineLength)]
+      if chromLength % lineLength:
+        lines.append(pool[0][:chromLength % lineLength])
+      f.write('\n'.join(lines))
+      f.write('\n')
+  return os.path.getsize(path)
+
+
+def report(name, numBytes, seconds):
+  """ print the throughput of a single benchmark.
+  """
+  print('%-32s %8.3f s %10.1f MB/s' % (name, seconds,
+                                        numBytes / 1e6 / max(seconds, 1e-9)))
+
+
+def timeIt(func, *args, **kwargs):
+  """ return the result of calling FUNC and the wall time it took.
+  """
+  t0 = time.time()
+  result = func(*args, **kwargs)
+  return result, time.time() - t0
+
+
+def benchFastaParsing(args, tmpDir):
+  """ parse throughput of getSequences() on a synthetic fasta.
+  """
+  fasta = os.path.join(tmpDir, 'synthetic.fa')
+  chromLength = args.size * 1000000 // args.chroms
+  numBytes = syntheticFasta(fasta, args.chroms, chromLength)
+  print('fasta: %d sequences, %.1f MB' % (args.chroms, numBytes / 1e6))
+  seqDict, seconds = timeIt(lib_filter.getSequences, fasta)
+  report('getSequences', numBytes, seconds)
+  del seqDict
+  seqDict, seconds = timeIt(lib_filter.getSequences, fasta, upper=True)
+  report('getSequences(upper=True)', numBytes, seconds)
+  del seqDict
+  index, seconds = timeIt(lib_filter.buildFastaIndex, fasta)
+  report('buildFastaIndex', numBytes, seconds)
+  twoBit, seconds = timeIt(lib_filter.fastaToTwoBit, fasta)
+  report('fastaToTwoBit', numBytes, seconds)
+  seqDict, seconds = timeIt(lib_filter.getSequences, fasta)
+  report('getSequences(.2bit cache)', numBytes, seconds)
+  rand = random.Random(0)
+  t0 = time.time()
+  for i in xrange(10000):
+    seq = seqDict['chr%d' % rand.randrange(args.chroms)]
+    start = rand.randrange(seq.getLength() - 3000)
+    seq.sliceSequence(start, start + 3000)
+  report('10k 3kb .2bit slices', 10000 * 3000, time.time() - t0)
+
+
+def syntheticSplicedAlignment(numExons, seed=0):
+  """ return a reference transcript of NUMEXONS exons, the transmapped
+  transcript and the psl that maps one to the other. About 30% of the exons
+  have an insertion and another 30% a deletion. As transMap does, the target
+  transcript has an intron on each insertion.
+  """
+  rand = random.Random(seed)
+  exons = []
+  p = 1000
+  for i in xrange(numExons):
+    size = rand.randint(60, 200)
+    exons.append(lib_filter.ChromosomeInterval('chrQ', p, p + size, True))
+    p += size + rand.randint(500, 2000)
+  original = lib_filter.Transcript(
+    lib_filter.ChromosomeInterval('chrQ', exons[0].start, exons[-1].stop, True),
+    'query', exons, [], 0, exons[0].start, exons[-1].stop, '0')
+  blocks = []  # (qStart, tStart, size)
+  q, t = 0, 1000
+  for e in exons:
+    size = e.stop - e.start
+    r = rand.random()
+    cut = rand.randint(10, size - 10)
+    gap = rand.randint(1, 6)
+    if r < 0.3:
+      # insertion, a gap in the target
+      blocks.extend([(q, t, cut), (q + cut, t + cut + gap, size - cut)])
+      t += gap
+    elif r < 0.6:
+      # deletion, a gap in the query
+      blocks.extend([(q, t, cut), (q + cut + gap, t + cut, size - cut - gap)])
+      t -= gap
+    else:
+      blocks.append((q, t, size))
+    q += size
+    t += size + rand.randint(300, 1500)
+  targetExons = []
+  for bq, bt, size in blocks:
+    if targetExons and targetExons[-1].stop == bt:
+      targetExons[-1].stop = bt + size
+    else:
+      targetExons.append(
+        lib_filter.ChromosomeInterval('chrT', bt, bt + size, True))
+  transcript = lib_filter.Transcript(
+    lib_filter.ChromosomeInterval(
+      'chrT', targetExons[0].start, targetExons[-1].stop, True),
+    'query', targetExons, [], 0, targetExons[0].start, targetExons[-1].stop,
+    '0')
+  alignment = lib_filter.PslRow(
+    '%d 0 0 0 0 0 0 0 + query %d 0 %d chrT %d %d %d %d %s, %s, %s,'
+    % (q, q, q, t, blocks[0][1], blocks[-1][1] + blocks[-1][2], len(blocks),
+       ','.join(str(b[2]) for b in blocks), ','.join(str(b[0]) for b in blocks),
+       ','.join(str(b[1]) for b in blocks)))
+  return original, transcript, alignment
+
+
+def benchIndel(args, tmpDir):
+  """ time per base of the indel filter's labeling and repair of a transcript,
+  which should not grow with the number of exons.
+  """
+  for numExons in [100, 200, 400, 800]:
+    original, transcript, alignment = syntheticSplicedAlignment(numExons)
+    numBases = original.getExonLength()
+    reps = max(1, 2000000 // numBases)
+    copies = [copy.deepcopy(transcript) for i in xrange(reps)]
+    t0 = time.time()
+    for t in copies:
+      insertions = indel.labelInsertions(original, t, alignment)
+      indel.labelDeletions(original, t, alignment)
+      insertions = lib_filter.IntervalSet(insertions)
+      indel.deleteIntronsOnInsertions(t, insertions)
+      indel.removeInvalidUnknownSpliceTags(t, insertions)
+    seconds = time.time() - t0
+    print('%-32s %8.3f s %10.1f ns/base'
+          % ('indel, %d exons' % numExons, seconds,
+             seconds / reps / numBases * 1e9))
+
+
+BENCHMARKS = [('fastaParsing', benchFastaParsing),
+              ('indel', benchIndel),
+              ]
+
+
+def main():
+  parser = ArgumentParser()
+  parser.add_argument('--benchmark', action='append',
+                      choices=[name for name, func in BENCHMARKS],
+                      help='benchmark to run, may be repeated. default: all')
+  parser.add_argument('--size', type=int, default=100,
+                      help='approximate size of synthetic inputs in MB. '
+                      'default=%(default)s')
+  parser.add_argument('--chroms', type=int, default=20,
+                      help='number of synthetic chromosomes. '
+                      'default=%(default)s')
+  args = parser.parse_args()
+  tmpDir = tempfile.mkdtemp(prefix='bench.lib_filter.')
+  try:
+    for name, func in BENCHMARKS:
+      if args.benchmark is None or name in args.benchmark:
+        print('== %s' % name)
+        func(args, tmpDir)
+  finally:
+    shutil.rmtree(tmpDir)
+
+
+if __name__ == '__main__':
+  main()
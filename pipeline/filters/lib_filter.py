@@ -2,9 +2,23 @@
 convenience library for assisting filters.
 """
 from argparse import ArgumentTypeError
+from bisect import bisect_right
 from collections import deque
+import hashlib
+import heapq
+from itertools import groupby
+import marshal
+import mmap
+import multiprocessing
+import numpy
 import os
+import re
+import sqlite3
+import stat
+import string
+import struct
 import sys
+import tempfile
 
 
 class Sequence(object):
@@ -35,6 +49,28 @@ class Sequence(object):
       # using slice sequence with '-' automatically complements
       n = self.sliceSequence(pos, pos + 1, relativeStrand='-')
     return n
+  def getNBlocks(self):
+    """ return the runs of Ns, in either case, as a pair of sorted arrays
+    (starts, ends), half open.
+    """
+    chars = numpy.frombuffer(self.getSequence(), dtype=numpy.uint8)
+    starts, sizes = _runs((chars == ord('N')) | (chars == ord('n')))
+    return starts, starts + sizes
+  def getNucleotides(self, positions, complementNuc=False):
+    """ Vectorized getNucleotide(): return the string of the nucleotides at
+    the 0-based POSITIONS, anything numpy can turn into an array of ints,
+    read with a single slice of the sequence.
+    """
+    positions = numpy.asarray(positions, dtype=numpy.int64)
+    if not len(positions):
+      return ''
+    start = int(positions.min())
+    stop = int(positions.max()) + 1
+    s = numpy.frombuffer(self._slice(start, stop), dtype=numpy.uint8)
+    s = s[positions - start].tostring()
+    if complementNuc:
+      s = complement(s)
+    return s
   def sliceSequence(self, start, stop, relativeStrand='+'):
     """ return the proper slice of the sequence.
     BED format coordinates: 0 based start, stop is exclusive
@@ -42,7 +78,7 @@ class Sequence(object):
     """
     assert(start < stop)
     if relativeStrand == '+':
-      return self._sequence[start:stop]
+      return self._slice(start, stop)
     elif relativeStrand == '-':
       # 0 1 2 3 4 5 6 7 8 9  +
       # 9 8 7 6 5 4 3 2 1 0  -
@@ -53,46 +89,188 @@ class Sequence(object):
       #       |---------|  [3, 9) = [1, 7)
       a = self._length - stop
       b = self._length - stop + (stop - start)
-      return reverseComplement(self._sequence[a:b])
+      return reverseComplement(self._slice(a, b))
     else:
       raise RuntimeError('Unanticipated relativeStrand: %s'
                          % str(relativeStrand))
+  def _slice(self, start, stop):
+    """ return the raw [start, stop) slice with python slice semantics.
+    """
+    return self._sequence[start:stop]
 
 
-class PslRow(object):
-  """ Represents a single row in a PSL file.
-  http://genome.ucsc.edu/FAQ/FAQformat.html#format2
+class MappedSequence(Sequence):
+  """ A Sequence whose nucleotides stay on disk. The fasta file is memory
+  mapped and a .fai style index (see getFastaIndex()) is used to locate
+  slices, so only the pages that are actually sliced get read in.
   """
-  __slots__ = ('matches', 'misMatches', 'repMatches', 'nCount',
-               'qNumInsert', 'qBaseInsert', 'tNumInsert', 'tBaseInsert',
-               'strand', 'qName', 'qSize', 'qStart', 'qEnd',
-               'tName', 'tSize', 'tStart', 'tEnd', 'blockCount',
-               'blockSizes', 'qStarts', 'tStarts')  # conserve memory
-  def __init__(self, line):
-    data = line.split()
-    assert(len(data) == 21)
-    self.matches = int(data[0])
-    self.misMatches = int(data[1])
-    self.repMatches = int(data[2])
-    self.nCount = int(data[3])
-    self.qNumInsert = int(data[4])
-    self.qBaseInsert = int(data[5])
-    self.tNumInsert = int(data[6])
-    self.tBaseInsert = int(data[7])
-    self.strand = data[8]
-    self.qName = data[9]
-    self.qSize = int(data[10])
-    self.qStart = int(data[11])
-    self.qEnd = int(data[12])
-    self.tName = data[13]
-    self.tSize = int(data[14])
-    self.tStart = int(data[15])
-    self.tEnd = int(data[16])
-    self.blockCount = int(data[17])
-    # lists of ints
-    self.blockSizes = [int(x) for x in data[18].split(',') if x]
-    self.qStarts = [int(x) for x in data[19].split(',') if x]
-    self.tStarts = [int(x) for x in data[20].split(',') if x]
+  __slots__ = ('_map', '_offset', '_lineBases', '_lineWidth',
+               '_upper')  # conserve memory
+  def __init__(self, name, length, mappedFile, offset, lineBases, lineWidth,
+               upper=False):
+    self.name = name
+    self._sequence = None  # only set if setSequence() is called
+    self._length = length
+    self._map = mappedFile  # mmap object, shared by all records in the file
+    self._offset = offset  # byte offset of the first nucleotide
+    self._lineBases = lineBases  # nucleotides per line
+    self._lineWidth = lineWidth  # bytes per line, including the newline
+    self._upper = upper
+  def setSequence(self, seq):
+    self._sequence = seq
+    self._length = len(seq)
+  def getSequence(self):
+    return self._slice(0, self._length)
+  def setUpper(self):
+    if self._sequence is not None:
+      self._sequence = self._sequence.upper()
+    self._upper = True
+  def _filePosition(self, pos):
+    """ return the byte offset in the mapped file of nucleotide POS.
+    """
+    return (self._offset + (pos // self._lineBases) * self._lineWidth +
+            pos % self._lineBases)
+  def _slice(self, start, stop):
+    if self._sequence is not None:
+      return self._sequence[start:stop]
+    # normalize exactly as str slicing would
+    start, stop, step = slice(start, stop).indices(self._length)
+    if start >= stop:
+      return ''
+    s = self._map[self._filePosition(start):self._filePosition(stop - 1) + 1]
+    s = s.translate(None, '\r\n')
+    if self._upper:
+      s = s.upper()
+    return s
+
+
+class TwoBitSequence(Sequence):
+  """ A Sequence stored in a memory mapped UCSC .2bit file: two bits per
+  nucleotide plus tables of N runs and soft-masked (lower case) runs. Only
+  the bytes covering a requested slice are decoded.
+  """
+  __slots__ = ('_map', '_recordOffset', '_dnaOffset', '_endian',
+               '_nBlocks', '_maskBlocks', '_upper')  # conserve memory
+  def __init__(self, name, mappedFile, recordOffset, endian, upper=False):
+    self.name = name
+    self._sequence = None  # only set if setSequence() is called
+    self._map = mappedFile
+    self._recordOffset = recordOffset
+    self._endian = endian  # struct byte order prefix, '<' or '>'
+    self._length = struct.unpack_from(
+      self._endian + 'I', self._map, recordOffset)[0]
+    self._dnaOffset = None  # record header is parsed on first use
+    self._nBlocks = None  # (starts, ends) lists
+    self._maskBlocks = None  # (starts, ends) lists
+    self._upper = upper
+  def setSequence(self, seq):
+    self._sequence = seq
+    self._length = len(seq)
+  def getSequence(self):
+    return self._slice(0, self._length)
+  def setUpper(self):
+    if self._sequence is not None:
+      self._sequence = self._sequence.upper()
+    self._upper = True
+  def getNBlocks(self):
+    """ return the runs of Ns, in either case, as a pair of sorted arrays
+    (starts, ends), half open. They are read from the record header, no
+    sequence is decoded.
+    """
+    self._readHeader()
+    return self._nBlocks
+  def _readBlocks(self, offset):
+    """ read a block count and its start and size arrays from OFFSET.
+    """
+    count = struct.unpack_from(self._endian + 'I', self._map, offset)[0]
+    offset += 4
+    dtype = numpy.dtype(self._endian + 'u4')
+    starts = numpy.frombuffer(self._map, dtype=dtype, count=count,
+                              offset=offset).astype(numpy.int64)
+    offset += 4 * count
+    sizes = numpy.frombuffer(self._map, dtype=dtype, count=count,
+                             offset=offset).astype(numpy.int64)
+    offset += 4 * count
+    return (starts, starts + sizes), offset
+  def _readHeader(self):
+    """ parse the N and mask block tables of this record.
+    """
+    if self._dnaOffset is not None:
+      return
+    offset = self._recordOffset + 4  # skip dnaSize
+    self._nBlocks, offset = self._readBlocks(offset)
+    self._maskBlocks, offset = self._readBlocks(offset)
+    self._dnaOffset = offset + 4  # skip reserved
+  def _slice(self, start, stop):
+    if self._sequence is not None:
+      return self._sequence[start:stop]
+    # normalize exactly as str slicing would
+    start, stop, step = slice(start, stop).indices(self._length)
+    if start >= stop:
+      return ''
+    self._readHeader()
+    first, last = start // 4, (stop - 1) // 4
+    packed = numpy.frombuffer(
+      self._map[self._dnaOffset + first:self._dnaOffset + last + 1],
+      dtype=numpy.uint8)
+    s = _twoBitDecode[packed].ravel()
+    s = s[start - first * 4:stop - first * 4]
+    inN = _blockMask(start, stop, self._nBlocks)
+    if inN is not None:
+      s[inN] = ord('N')
+    if not self._upper:
+      inMask = _blockMask(start, stop, self._maskBlocks)
+      if inMask is not None:
+        s[inMask] += ord('a') - ord('A')
+    return s.tostring()
+
+
+class NRunIndex(object):
+  """ The runs of Ns of the Sequences of a sequence dict, to ask whether an
+  interval contains Ns, or how many, by binary search rather than by slicing
+  the sequence. The runs of a sequence are found the first time it is asked
+  about, with Sequence.getNBlocks().
+  """
+  def __init__(self, seqDict):
+    self._seqDict = seqDict
+    self._nBlocks = {}  # name: (starts, ends)
+
+  def getNBlocks(self, name):
+    if name not in self._nBlocks:
+      self._nBlocks[name] = self._seqDict[name].getNBlocks()
+    return self._nBlocks[name]
+
+  def _overlapping(self, interval):
+    """ return the (starts, ends) of the N runs overlapping INTERVAL, a
+    ChromosomeInterval. An empty interval overlaps no runs.
+    """
+    starts, ends = self.getNBlocks(interval.chromosome)
+    if interval.start >= interval.stop:
+      return starts[:0], ends[:0]
+    i = numpy.searchsorted(ends, interval.start, side='right')
+    j = numpy.searchsorted(starts, interval.stop, side='left')
+    return starts[i:j], ends[i:j]
+
+  def containsN(self, interval):
+    """ return True if INTERVAL, a ChromosomeInterval, contains an N.
+    """
+    starts, ends = self._overlapping(interval)
+    return len(starts) > 0
+
+  def countNs(self, interval):
+    """ return the number of Ns in INTERVAL, a ChromosomeInterval.
+    """
+    starts, ends = self._overlapping(interval)
+    return int((numpy.minimum(ends, interval.stop) -
+                numpy.maximum(starts, interval.start)).sum())
+
+
+class _PslCoordinates(object):
+  """ The coordinate mapping and formatting of a row of a PSL file, shared by
+  PslRow and PslTableRow, which provide the PSL fields as attributes and
+  _getBlockArrays().
+  """
+  __slots__ = ()
   def hashkey(self):
     """ return a string to use as dict key.
     """
@@ -106,18 +284,17 @@ class PslRow(object):
     if p >= self.tEnd: return None
     if self.strand not in ['+', '-']:
       raise RuntimeError('Unanticipated strand: %s' % self.strand)
-    for i, t in enumerate(self.tStarts):
-      if p < t:
-        continue
-      if p >= t + self.blockSizes[i]:
-        continue
-      # p must be in block
-      offset = p - t
-      if self.strand == '+':
-        return self.qStarts[i] + offset
-      else:
-        return self.qSize - (self.qStarts[i] + offset) - 1
-    return None
+    # blocks are sorted and do not overlap, binary search for the last block
+    # starting at or before p.
+    i = bisect_right(self.tStarts, p) - 1
+    if i < 0 or p >= self.tStarts[i] + self.blockSizes[i]:
+      return None
+    # p must be in block
+    offset = p - self.tStarts[i]
+    if self.strand == '+':
+      return self.qStarts[i] + offset
+    else:
+      return self.qSize - (self.qStarts[i] + offset) - 1
   def queryCoordinateToTarget(self, p):
     """ Take position P in query coordinates (positive) and convert it
     to target coordinates (positive). If P is not in query coordinates throw
@@ -132,15 +309,120 @@ class PslRow(object):
       raise RuntimeError('Unanticipated strand: %s' % self.strand)
     if p < self.qStart: return None
     if p >= self.qEnd: return None
-    for i, q in enumerate(self.qStarts):
-      if p < q:
-        continue
-      if p >= q + self.blockSizes[i]:
-        continue
-      # p must be in block
-      offset = p - q
-      return self.tStarts[i] + offset
-    return None
+    i = bisect_right(self.qStarts, p) - 1
+    if i < 0 or p >= self.qStarts[i] + self.blockSizes[i]:
+      return None
+    # p must be in block
+    return self.tStarts[i] + p - self.qStarts[i]
+  def targetCoordinatesToQuery(self, positions):
+    """ Vectorized targetCoordinateToQuery(). Take POSITIONS, anything that
+    numpy can turn into an array of ints (a list, an xrange, an array),
+    and return a numpy int array of query coordinates with -1 wherever
+    targetCoordinateToQuery() would return None.
+    """
+    if self.strand not in ['+', '-']:
+      raise RuntimeError('Unanticipated strand: %s' % self.strand)
+    sizes, qStarts, tStarts = self._getBlockArrays()
+    p = numpy.asarray(positions, dtype=numpy.int64)
+    if not len(tStarts):
+      return numpy.full(p.shape, -1, dtype=numpy.int64)
+    i = numpy.searchsorted(tStarts, p, side='right') - 1
+    j = numpy.maximum(i, 0)
+    offset = p - tStarts[j]
+    mapped = ((i >= 0) & (offset < sizes[j]) &
+              (p >= self.tStart) & (p < self.tEnd))
+    q = qStarts[j] + offset
+    if self.strand == '-':
+      q = self.qSize - q - 1
+    return numpy.where(mapped, q, -1)
+  def queryCoordinatesToTarget(self, positions):
+    """ Vectorized queryCoordinateToTarget(). Take POSITIONS, anything that
+    numpy can turn into an array of ints, and return a numpy int array of
+    target coordinates with -1 wherever queryCoordinateToTarget() would
+    return None.
+    """
+    if self.strand not in ['+', '-']:
+      raise RuntimeError('Unanticipated strand: %s' % self.strand)
+    sizes, qStarts, tStarts = self._getBlockArrays()
+    p = numpy.asarray(positions, dtype=numpy.int64)
+    if self.strand == '-':
+      p = self.qSize - p - 1
+    if not len(qStarts):
+      return numpy.full(p.shape, -1, dtype=numpy.int64)
+    i = numpy.searchsorted(qStarts, p, side='right') - 1
+    j = numpy.maximum(i, 0)
+    offset = p - qStarts[j]
+    mapped = ((i >= 0) & (offset < sizes[j]) &
+              (p >= self.qStart) & (p < self.qEnd))
+    return numpy.where(mapped, tStarts[j] + offset, -1)
+  def _blockRuns(self, starts, otherStarts, start, stop):
+    """ return the runs of positions in [START, STOP) covered by the blocks
+    that begin at STARTS, as (runStart, runStop, otherStart) in the order of
+    STARTS. Like the binary searches of the coordinate mapping, a position
+    maps through the last block starting at or before it.
+    """
+    runs = []
+    sizes = self.blockSizes
+    n = len(starts)
+    i = max(bisect_right(starts, start) - 1, 0)
+    while i < n and starts[i] < stop:
+      end = starts[i] + sizes[i]
+      if i + 1 < n:
+        end = min(end, starts[i + 1])
+      runStart = max(starts[i], start)
+      runStop = min(end, stop)
+      if runStart < runStop:
+        runs.append((runStart, runStop,
+                     otherStarts[i] + runStart - starts[i]))
+      i += 1
+    return runs
+  def targetBlocks(self, start, stop):
+    """ return the aligned runs of the target positions in [START, STOP) as a
+    list of (tStart, tStop, qStart) in target order. Target position
+    tStart + k maps to query position qStart + k on the + strand and
+    qStart - k on the - strand, as targetCoordinateToQuery() would map it.
+    """
+    start = max(start, self.tStart)
+    stop = min(stop, self.tEnd)
+    if start >= stop:
+      return []
+    if self.strand not in ['+', '-']:
+      raise RuntimeError('Unanticipated strand: %s' % self.strand)
+    runs = self._blockRuns(self.tStarts, self.qStarts, start, stop)
+    if self.strand == '-':
+      runs = [(s, e, self.qSize - q - 1) for s, e, q in runs]
+    return runs
+  def queryBlocks(self, start, stop):
+    """ return the aligned runs of the query positions in [START, STOP) as a
+    list of (qStart, qStop, tStart) in query order. Query position qStart + k
+    maps to target position tStart + k on the + strand and tStart - k on the
+    - strand, as queryCoordinateToTarget() would map it.
+    """
+    if self.strand == '+':
+      return self._blockRuns(self.qStarts, self.tStarts,
+                             max(start, self.qStart), min(stop, self.qEnd))
+    elif self.strand != '-':
+      raise RuntimeError('Unanticipated strand: %s' % self.strand)
+    # on the - strand query position p is qSize - p - 1 in the blocks
+    runs = self._blockRuns(self.qStarts, self.tStarts,
+                           max(self.qSize - stop, self.qStart),
+                           min(self.qSize - start, self.qEnd))
+    return [(self.qSize - e, self.qSize - s, t + e - s - 1)
+            for s, e, t in reversed(runs)]
+  def targetToQueryMap(self):
+    """ return a numpy int array over the target range [tStart, tEnd):
+    element i holds the query position of target position tStart + i, or -1
+    if it does not align.
+    """
+    return self.targetCoordinatesToQuery(
+      numpy.arange(self.tStart, self.tEnd, dtype=numpy.int64))
+  def queryToTargetMap(self):
+    """ return a numpy int array over the query range [0, qSize): element i
+    holds the target position of query position i, or -1 if it does not
+    align.
+    """
+    return self.queryCoordinatesToTarget(
+      numpy.arange(self.qSize, dtype=numpy.int64))
   def pslString(self):
     """ return SELF as a psl formatted line.
     """
@@ -170,6 +452,52 @@ class PslRow(object):
     return s
 
 
+class PslRow(_PslCoordinates):
+  """ Represents a single row in a PSL file.
+  http://genome.ucsc.edu/FAQ/FAQformat.html#format2
+  """
+  __slots__ = ('matches', 'misMatches', 'repMatches', 'nCount',
+               'qNumInsert', 'qBaseInsert', 'tNumInsert', 'tBaseInsert',
+               'strand', 'qName', 'qSize', 'qStart', 'qEnd',
+               'tName', 'tSize', 'tStart', 'tEnd', 'blockCount',
+               'blockSizes', 'qStarts', 'tStarts',
+               '_blockArrays')  # conserve memory
+  def __init__(self, line):
+    data = line.split()
+    assert(len(data) == 21)
+    self.matches = int(data[0])
+    self.misMatches = int(data[1])
+    self.repMatches = int(data[2])
+    self.nCount = int(data[3])
+    self.qNumInsert = int(data[4])
+    self.qBaseInsert = int(data[5])
+    self.tNumInsert = int(data[6])
+    self.tBaseInsert = int(data[7])
+    self.strand = data[8]
+    self.qName = data[9]
+    self.qSize = int(data[10])
+    self.qStart = int(data[11])
+    self.qEnd = int(data[12])
+    self.tName = data[13]
+    self.tSize = int(data[14])
+    self.tStart = int(data[15])
+    self.tEnd = int(data[16])
+    self.blockCount = int(data[17])
+    # lists of ints
+    self.blockSizes = [int(x) for x in data[18].split(',') if x]
+    self.qStarts = [int(x) for x in data[19].split(',') if x]
+    self.tStarts = [int(x) for x in data[20].split(',') if x]
+    self._blockArrays = None  # built on first use by _getBlockArrays()
+  def _getBlockArrays(self):
+    """ return (blockSizes, qStarts, tStarts) as numpy arrays, built once.
+    """
+    if self._blockArrays is None:
+      self._blockArrays = tuple(
+        numpy.array(x, dtype=numpy.int64)
+        for x in (self.blockSizes, self.qStarts, self.tStarts))
+    return self._blockArrays
+
+
 """The following data types are used for iterating over gene-check-detail and
 gene-check bed files.
 An example of entries from such files:
@@ -205,6 +533,11 @@ class ChromosomeInterval(object):
             self.stop == other.stop and
             self.strand == other.strand)
 
+  def __hash__(self):
+    # by value, as __eq__ is. Do not change an interval that is in a set or
+    # is a dict key.
+    return hash((self.chromosome, self.start, self.stop, self.strand))
+
   def __cmp__(self, cI):
     return cmp((self.chromosome, self.start, self.stop, self.strand),
                (cI.chromosome, cI.start, cI.stop, cI.strand))
@@ -292,17 +625,209 @@ class TranscriptAnnotation(object):
             self.name == other.name and
             self.labels == other.labels)
 
+  def __hash__(self):
+    # by value, as __eq__ is. Do not change an annotation (i.e. addLabel())
+    # that is in a set or is a dict key.
+    return hash((self.chromosomeInterval, self.name, tuple(self.labels)))
+
   def __cmp__(self, annotation):
     """ Sort by chromosome interval, then name
     """
     return cmp((self.chromosomeInterval, self.name),
                (annotation.chromosomeInterval, annotation.name))
 
+
+class IntervalSet(object):
+  """ A set of ChromosomeIntervals, compared by value, with constant time
+  membership tests (the in operator). Intervals must not be changed while
+  they are in the set. See IntervalIndex for region queries.
+  """
+  def __init__(self, intervals=()):
+    self._intervals = set(intervals)
+
+  def add(self, interval):
+    self._intervals.add(interval)
+
+  def __contains__(self, interval):
+    return interval in self._intervals
+
+  def __len__(self):
+    return len(self._intervals)
+
+  def __iter__(self):
+    return iter(self._intervals)
+
+
+class IntervalIndex(object):
+  """ An index of values by ChromosomeInterval, to find the values of the
+  intervals within a query interval. The intervals of each chromosome are
+  kept as numpy arrays sorted by start, along with the running maximum of
+  their stops (an augmented sorted array interval tree), so that a query
+  bisects to the intervals that can reach it and scans only those. Strands
+  are ignored and query results are in the order the values were added. A
+  chromosome's arrays are built by its first query after an add().
+  """
+  def __init__(self, items=()):
+    self._added = {}  # chromosome: list of (start, stop, value)
+    self._arrays = {}  # chromosome: see _getArrays()
+    for interval, value in items:
+      self.add(interval, value)
+
+  def add(self, interval, value=None):
+    """ add VALUE (INTERVAL if None) for INTERVAL.
+    """
+    if value is None:
+      value = interval
+    self._added.setdefault(interval.chromosome, []).append(
+      (interval.start, interval.stop, value))
+    self._arrays.pop(interval.chromosome, None)
+
+  def __len__(self):
+    return sum(len(added) for added in self._added.itervalues())
+
+  def _getArrays(self, chromosome):
+    """ return (starts, stops, maxStops, order, values) for CHROMOSOME, the
+    first three sorted by start, order the index in VALUES, the values in the
+    order added, of each.
+    """
+    arrays = self._arrays.get(chromosome)
+    if arrays is None:
+      added = self._added.get(chromosome, [])
+      starts = numpy.array([a[0] for a in added], dtype=numpy.int64)
+      stops = numpy.array([a[1] for a in added], dtype=numpy.int64)
+      order = numpy.argsort(starts, kind='mergesort')
+      starts, stops = starts[order], stops[order]
+      maxStops = numpy.maximum.accumulate(stops) if len(stops) else stops
+      arrays = (starts, stops, maxStops, order, [a[2] for a in added])
+      self._arrays[chromosome] = arrays
+    return arrays
+
+  def _candidates(self, interval):
+    """ return the arrays of INTERVAL's chromosome and the range [lo, hi) of
+    sorted positions outside of which no interval overlaps INTERVAL.
+    """
+    arrays = self._getArrays(interval.chromosome)
+    starts, stops, maxStops = arrays[:3]
+    lo = int(numpy.searchsorted(maxStops, interval.start, side='right'))
+    hi = int(numpy.searchsorted(starts, interval.stop, side='left'))
+    return arrays, lo, max(lo, hi)
+
+  def _values(self, arrays, positions):
+    """ return the values at the sorted POSITIONS in the order added.
+    """
+    values = arrays[4]
+    return [values[i] for i in numpy.sort(arrays[3][positions]).tolist()]
+
+  def within(self, interval):
+    """ return the values of the intervals that INTERVAL contains(), see
+    ChromosomeInterval.contains().
+    """
+    arrays, lo, hi = self._candidates(interval)
+    starts, stops = arrays[0][lo:hi], arrays[1][lo:hi]
+    keep = ((stops > interval.start) & (starts >= interval.start)
+            & (stops <= interval.stop))
+    return self._values(arrays, lo + numpy.flatnonzero(keep))
+
+
+class _ExonCache(object):
+  """ The exon layout of a Transcript, computed once and used by all of the
+  Transcript coordinate transforms. See Transcript._getExonCache().
+  """
+  __slots__ = ('exons', 'key', 'starts', 'offsets', 'length', 'mRnaOffset',
+               'exonThickStart', 'exonThickEnd', 'mRnaSlices',
+               '_arrays')  # conserve memory
+  def __init__(self, transcript, key):
+    # the exon list itself rather than its id(), which a new list may reuse
+    # once this one is freed
+    self.exons = transcript.exons
+    self.key = key
+    self._arrays = None  # see getArrays()
+    t = transcript
+    self.starts = [e.start for e in t.exons]  # chromosome order
+    self.offsets = []  # exon space position of the start of each exon
+    self.length = 0  # total length of all exons
+    for e in t.exons:
+      self.offsets.append(self.length)
+      self.length += e.stop - e.start
+    # offset from mRNA coordinates to exon coordinates
+    #
+    # positive strand
+    # chromosome +++++++++++
+    #            |    |    |
+    # exon        ..++ ++++.  two exons (thick and thin parts)
+    #             |     |  |
+    # mrna          ++ ++++
+    #               |     |
+    # so to go from mrna to exon, we must add on the difference
+    # between the thick start and thin start from the "start".
+    p = 0
+    if t.chromosomeInterval.strand:
+      # positive strand, offset is first exon start to thickStart
+      for e in t.exons:
+        if e.start < t.thickStart and e.stop <= t.thickStart:
+          # add the whole exon to the offset
+          p += e.stop - e.start
+        elif e.start < t.thickStart and t.thickStart <= e.stop:
+          # only add the thin part of this exon
+          p += t.thickStart - e.start
+          break
+    else:
+      for e in reversed(t.exons):
+        if t.thickEnd < e.start and t.thickEnd < e.stop:
+          # add the whole exon to the offset
+          p += e.stop - e.start
+        elif e.start < t.thickEnd and t.thickEnd < e.stop:
+          # only add the thin part of this exon
+          p += e.stop -  t.thickEnd
+          break
+    self.mRnaOffset = p
+    # find the thickStart, thickEnd offsets in exon coordinates
+    exonThickStart, exonThickEnd = None, None
+    x = 0  # exon coordinate
+    for e in t.exons:
+      length = e.stop - e.start
+      if exonThickStart is None and e.start >= t.thickStart:
+        # thickStart fell between exons
+        exonThickStart = x
+      if exonThickStart is None and e.stop > t.thickStart:
+        # exon contains thickStart
+        exonThickStart = x + t.thickStart - e.start
+      if exonThickEnd is None and e.start >= t.thickEnd:
+        # thickEnd fell between exons
+        exonThickEnd = x
+      if exonThickEnd is None and e.stop >= t.thickEnd:
+        # exon contains thickEnd
+        exonThickEnd = x + t.thickEnd - e.start
+      x += length
+    if (not t.chromosomeInterval.strand and
+        exonThickStart is not None and exonThickEnd is not None):
+      exonThickStart, exonThickEnd = exonThickEnd, exonThickStart
+      exonThickStart = x - exonThickStart
+      exonThickEnd = x - exonThickEnd
+    self.exonThickStart = exonThickStart
+    self.exonThickEnd = exonThickEnd
+    # the thick parts of the exons, chromosome order
+    self.mRnaSlices = [(max(e.start, t.thickStart), min(e.stop, t.thickEnd))
+                       for e in t.exons
+                       if e.start < t.thickEnd and t.thickStart < e.stop]
+
+  def getArrays(self, transcript):
+    """ return numpy arrays of the exon (starts, stops, offsets), built once.
+    """
+    if self._arrays is None:
+      self._arrays = (
+        numpy.array(self.starts, dtype=numpy.int64),
+        numpy.array([e.stop for e in transcript.exons], dtype=numpy.int64),
+        numpy.array(self.offsets, dtype=numpy.int64))
+    return self._arrays
+
+
 class Transcript(object):
   """ Represent a transcript and its annotations
   """
   __slots__ = ('chromosomeInterval', 'name', 'exons', 'annotations',
-               'score', 'thickStart', 'thickEnd', 'itemRgb')  # conserve memory
+               'score', 'thickStart', 'thickEnd', 'itemRgb',
+               '_exonCache')  # conserve memory
   def __init__(self, chromosomeInterval, name, exons, annotations,
                score, thickStart, thickEnd, itemRgb):
     self.chromosomeInterval = chromosomeInterval
@@ -314,6 +839,7 @@ class Transcript(object):
     self.thickStart = thickStart  # int
     self.thickEnd = thickEnd  # int
     self.itemRgb = itemRgb
+    self._exonCache = None  # see _getExonCache()
 
   def __eq__(self, other):
     return (self.chromosomeInterval == other.chromosomeInterval and
@@ -338,6 +864,35 @@ class Transcript(object):
                               self.chromosomeInterval.start,
                               self.chromosomeInterval.stop)
 
+  def invalidateCache(self):
+    """ Drop the cached exon layout. Must be called after modifying the
+    exons in place (i.e. changing an exon's start or stop). Replacing
+    self.exons or changing thickStart, thickEnd or the strand is noticed
+    without calling this.
+    """
+    self._exonCache = None
+
+  def _getExonCache(self):
+    """ return the _ExonCache for the current exons, building it if needed.
+    """
+    key = (len(self.exons), self.thickStart, self.thickEnd,
+           self.chromosomeInterval.strand)
+    if (self._exonCache is None or self._exonCache.exons is not self.exons or
+        self._exonCache.key != key):
+      self._exonCache = _ExonCache(self, key)
+    return self._exonCache
+
+  def getExonLength(self):
+    """ return the total length of the exons.
+    """
+    return self._getExonCache().length
+
+  def getMRnaLength(self):
+    """ return the length of the mRNA (the thick part of the exons).
+    """
+    c = self._getExonCache()
+    return c.exonThickEnd - c.exonThickStart
+
   def mRnaCoordinateToCodon(self, p):
     """ Take position P with 0-based mRNA-relative position and convert it
     to 0-based (codon, codon position) tuple.
@@ -351,7 +906,7 @@ class Transcript(object):
     #       0,0   2,0
     if p is None: return None
     assert(p >= 0)
-    assert(p < sum([(e.stop - e.start) for e in self.exons]))  # could be a tighter bound
+    assert(p < self._getExonCache().length)  # could be a tighter bound
     return (int(p / 3), p % 3)
 
   def codonCoordinateToMRna(self, p):
@@ -391,36 +946,9 @@ class Transcript(object):
     assert(len(self.exons))
     if p is None: return None
     if p < 0: return None
-    if p >= sum([(e.stop - e.start) for e in self.exons]): return None
-    # positive strand
-    # chromosome +++++++++++
-    #            |    |    |
-    # exon        ..++ ++++.  two exons (thick and thin parts)
-    #             |     |  |
-    # mrna          ++ ++++
-    #               |     |
-    # so to go from mrna to exon, we must add on the difference
-    # between the thick start and thin start from the "start".
-    if self.chromosomeInterval.strand:
-      # positive strand, offset is first exon start to thickStart
-      for e in self.exons:
-        if e.start < self.thickStart and e.stop <= self.thickStart:
-          # add the whole exon to the offset
-          p += e.stop - e.start
-        elif e.start < self.thickStart and self.thickStart <= e.stop:
-          # only add the thin part of this exon
-          p += self.thickStart - e.start
-          break
-    else:
-      for e in reversed(self.exons):
-        if self.thickEnd < e.start and self.thickEnd < e.stop:
-          # add the whole exon to the offset
-          p += e.stop - e.start
-        elif e.start < self.thickEnd and self.thickEnd < e.stop:
-          # only add the thin part of this exon
-          p += e.stop -  self.thickEnd
-          break
-    return p
+    c = self._getExonCache()
+    if p >= c.length: return None
+    return p + c.mRnaOffset
 
   def exonCoordinateToMRna(self, p):
     """ Take position P with 0-based exon-relative position and convert it
@@ -428,33 +956,12 @@ class Transcript(object):
     return None.
     """
     if p is None: return None
-    # find the thickStart, thickEnd offsets in exon coordinates
-    exonThickStart, exonThickEnd = None, None
-    x = 0  # exon coordinate
-    for e in self.exons:
-      length = e.stop - e.start
-      if exonThickStart is None and e.start >= self.thickStart:
-        # thickStart fell between exons
-        exonThickStart = x
-      if exonThickStart is None and e.stop > self.thickStart:
-        # exon contains thickStart
-        exonThickStart = x + self.thickStart - e.start
-      if exonThickEnd is None and e.start >= self.thickEnd:
-        # thickEnd fell between exons
-        exonThickEnd = x
-      if exonThickEnd is None and e.stop >= self.thickEnd:
-        # exon contains thickEnd
-        exonThickEnd = x + self.thickEnd - e.start
-      x += length
-    if not self.chromosomeInterval.strand:
-      exonThickStart, exonThickEnd = exonThickEnd, exonThickStart
-      exonThickStart = x - exonThickStart
-      exonThickEnd = x - exonThickEnd
-    if p < exonThickStart:
+    c = self._getExonCache()
+    if p < c.exonThickStart:
       return None
-    if p >= exonThickEnd:
+    if p >= c.exonThickEnd:
       return None
-    return p - exonThickStart
+    return p - c.exonThickStart
 
   def mRnaCoordinateToChromosome(self, p):
     """ Take position P with 0-based mRNA-relative position and convert it
@@ -463,7 +970,7 @@ class Transcript(object):
     assert(len(self.exons))
     if p is None: return None
     if p < 0: return None
-    limit = sum([(e.stop - e.start) for e in self.exons])
+    limit = self._getExonCache().length
     if p >= limit: return None
     p = self.mRnaCoordinateToExon(p)
     if p >= limit: return None
@@ -476,21 +983,15 @@ class Transcript(object):
     if p is None: return None
     if p < 0:
       return None
-    if p >= sum([(e.stop - e.start) for e in self.exons]):
+    c = self._getExonCache()
+    if p >= c.length:
       return None
     assert(len(self.exons))
-    c = 0  # cumulative position through exon space
     if not self.chromosomeInterval.strand:
-      p = sum([(e.stop - e.start) for e in self.exons]) - 1 - p
-    e_start = self.exons[0].start
-    for e in self.exons:
-      if p < c + e.stop - e.start:
-        # the position is within this exon
-        return p - c + e.start
-      else:
-        # sorry mario, your position is in another exon
-        c += e.stop - e.start
-    assert(False)  # we should never get here
+      p = c.length - 1 - p
+    # the last exon starting (in exon space) at or before p contains p
+    i = bisect_right(c.offsets, p) - 1
+    return p - c.offsets[i] + self.exons[i].start
 
   def chromosomeCoordinateToExon(self, p):
     """ Take position P with 0-based chromosome-relative position and convert it
@@ -498,24 +999,19 @@ class Transcript(object):
     exon, return None.
     """
     if p is None: return None
+    c = self._getExonCache()
+    i = bisect_right(c.starts, p) - 1
+    if i < 0:
+      # p is before the first exon
+      return None
+    e = self.exons[i]
+    if p >= e.stop:
+      # p is not in an exon
+      return None
+    v = c.offsets[i] + p - e.start
     if self.chromosomeInterval.strand:
-      def _stranded(v): return v
-    else:
-      def _stranded(v):
-        return sum([(e.stop - e.start) for e in self.exons]) - 1 - v
-    c = 0  # cumulative position through exon space
-    e_start = self.exons[0].start
-    for e in self.exons:
-      if p < e.start:
-        # p is not in an exon
-        return None
-      if p < e.stop:
-        # the position is within this exon
-        return _stranded(c + p - e.start)
-      else:
-        # sorry mario, your position is in another exon
-        c += e.stop - e.start
-    return None
+      return v
+    return c.length - 1 - v
 
   def chromosomeCoordinateToMRna(self, p):
     """ Take position P with 0-based chromosome-relative position and convert it
@@ -532,37 +1028,101 @@ class Transcript(object):
       return None
     if q < 0:
       return None
-    if q >= sum([(e.stop - e.start) for e in self.exons]):
+    if q >= self._getExonCache().length:
       return None
     return self.exonCoordinateToMRna(q)
 
+  def exonCoordinatesToChromosome(self, positions):
+    """ Vectorized exonCoordinateToChromosome(). Take POSITIONS, anything
+    numpy can turn into an array of ints, and return a numpy int array with
+    -1 wherever exonCoordinateToChromosome() would return None.
+    """
+    c = self._getExonCache()
+    starts, stops, offsets = c.getArrays(self)
+    p = numpy.asarray(positions, dtype=numpy.int64)
+    valid = (p >= 0) & (p < c.length)
+    if not self.chromosomeInterval.strand:
+      p = c.length - 1 - p
+    i = numpy.maximum(numpy.searchsorted(offsets, p, side='right') - 1, 0)
+    return numpy.where(valid, p - offsets[i] + starts[i], -1)
+
+  def chromosomeCoordinatesToExon(self, positions):
+    """ Vectorized chromosomeCoordinateToExon(), returns -1 for None.
+    """
+    c = self._getExonCache()
+    starts, stops, offsets = c.getArrays(self)
+    p = numpy.asarray(positions, dtype=numpy.int64)
+    i = numpy.searchsorted(starts, p, side='right') - 1
+    j = numpy.maximum(i, 0)
+    valid = (i >= 0) & (p < stops[j])
+    v = offsets[j] + p - starts[j]
+    if not self.chromosomeInterval.strand:
+      v = c.length - 1 - v
+    return numpy.where(valid, v, -1)
+
+  def exonCoordinatesToMRna(self, positions):
+    """ Vectorized exonCoordinateToMRna(), returns -1 for None. -1 is
+    accepted as input and maps to -1.
+    """
+    c = self._getExonCache()
+    p = numpy.asarray(positions, dtype=numpy.int64)
+    if c.exonThickStart is None or c.exonThickEnd is None:
+      return numpy.full(p.shape, -1, dtype=numpy.int64)
+    valid = (p >= c.exonThickStart) & (p < c.exonThickEnd)
+    return numpy.where(valid, p - c.exonThickStart, -1)
+
+  def mRnaCoordinatesToChromosome(self, positions):
+    """ Vectorized mRnaCoordinateToChromosome(), returns -1 for None.
+    """
+    c = self._getExonCache()
+    p = numpy.asarray(positions, dtype=numpy.int64)
+    e = p + c.mRnaOffset
+    valid = (p >= 0) & (p < c.length) & (e < c.length)
+    return numpy.where(valid, self.exonCoordinatesToChromosome(e), -1)
+
+  def chromosomeCoordinatesToMRna(self, positions):
+    """ Vectorized chromosomeCoordinateToMRna(), returns -1 for None.
+    """
+    p = numpy.asarray(positions, dtype=numpy.int64)
+    valid = (p >= 0) & (p < self.chromosomeInterval.stop)
+    q = self.chromosomeCoordinatesToExon(p)
+    return numpy.where(valid, self.exonCoordinatesToMRna(q), -1)
+
+  def exonToChromosomeMap(self):
+    """ return a numpy int array, one element per exon position, holding the
+    chromosome position of each exon position.
+    """
+    return self.exonCoordinatesToChromosome(
+      numpy.arange(self.getExonLength(), dtype=numpy.int64))
+
+  def mRnaToChromosomeMap(self):
+    """ return a numpy int array, one element per mRNA position, holding the
+    chromosome position of each mRNA position, or -1 if it has none.
+    """
+    return self.mRnaCoordinatesToChromosome(
+      numpy.arange(self.getMRnaLength(), dtype=numpy.int64))
+
+  def getMRnaSlices(self):
+    """ return the list of [start, stop) chromosome slices, in chromosome
+    order, whose + strand sequences make up the mRNA, i.e. the thick parts of
+    the exons.
+    """
+    # chromosome    ttttTTTTTTTTTTTtttt  t: thin T: THICK
+    # exon            eeeeee eeee eee
+    # mrna              mmmm mmmm m
+    return self._getExonCache().mRnaSlices
+
   def getMRna(self, sequence):
     """ Return the mRNA sequence for the transcript (based on the exons) using
     a SEQUENCE object as the source for dna sequence.
     The returned sequence is in the correct 5'-3' orientation (i.e. it has
-    been reverse complemented if necessary).
+    been reverse complemented if necessary). See getMRnas() for the mRNAs of
+    many transcripts at once.
     """
     assert(self.chromosomeInterval.chromosome == sequence.name)
     assert(self.chromosomeInterval.stop <= sequence.getLength())
-    s = ''
-    # chromosome    ttttTTTTTTTTTTTtttt  t: thin T: THICK
-    # exon            eeeeee eeee eee
-    # mrna              mmmm mmmm m
-    for e in self.exons:
-      if self.thickStart < e.start and e.stop < self.thickEnd:
-        # squarely in the CDS
-        s += sequence.sliceSequence(e.start, e.stop)
-      elif (e.start <= self.thickStart and e.stop < self.thickEnd
-            and self.thickStart < e.stop):
-        # thickStart marks the start of the mRNA
-        s += sequence.sliceSequence(self.thickStart, e.stop)
-      elif e.start <= self.thickStart and self.thickEnd <= e.stop:
-        # thickStart and thickEnd mark the whole mRNA
-        s += sequence.sliceSequence(self.thickStart, self.thickEnd)
-      elif (self.thickStart < e.start and self.thickEnd <= e.stop
-            and e.start < self.thickEnd):
-        # thickEnd marks the end of the mRNA
-        s += sequence.sliceSequence(e.start, self.thickEnd)
+    s = ''.join([sequence._slice(start, stop)
+                 for start, stop in self.getMRnaSlices()])
     if not self.chromosomeInterval.strand:
       s = reverseComplement(s)
     return s
@@ -628,12 +1188,14 @@ def DirType(d):
 
 
 def FileType(f):
-  """ given a string path to a file, F, verify it can be used.
+  """ given a string path to a file, F, verify it can be used. Named pipes
+  (i.e. /dev/stdin or bash's <(command)) are accepted so that filters can be
+  chained without intermediate files.
   """
   f = os.path.abspath(f)
   if not os.path.exists(f):
     raise ArgumentTypeError('FileType:%s does not exist' % f)
-  if not os.path.isfile(f):
+  if not os.path.isfile(f) and not stat.S_ISFIFO(os.stat(f).st_mode):
     raise ArgumentTypeError('FileType:%s is not a regular file' % f)
   if os.access(f, os.R_OK):
     return f
@@ -671,6 +1233,21 @@ def initializeArguments(parser):
   parser.add_argument('--chromSizes', type=FileType)
   parser.add_argument('--outDir', type=DirType)
   parser.add_argument('--mode', choices=['transmap', 'augustus'])
+  parser.add_argument('--workers', type=int, default=1,
+                      help='number of processes for the filters that can '
+                      'use more than one, see mapTranscripts(). '
+                      'default=%(default)s')
+  parser.add_argument('--memoDb', type=os.path.abspath, default=None,
+                      help='sqlite database of per-transcript results to '
+                      'reuse from earlier runs, see MemoStore. '
+                      'default=%(default)s')
+  parser.add_argument('--sortedInput', action='store_true', default=False,
+                      help='the geneCheckBed and geneCheckBedDetails are '
+                      'sorted by chromosome, as the output of every filter '
+                      'is. They are then read together a chromosome at a '
+                      'time, holding only one chromosome of annotations in '
+                      'memory, which also works on pipes. Unsorted input is '
+                      'an error. default=%(default)s')
 
 
 def checkArguments(args, parser):
@@ -686,6 +1263,8 @@ def checkArguments(args, parser):
   for name, value in pairs:
     if value is None:
       parser.error('Specify --%s' % name)
+  if args.workers < 1:
+    parser.error('--workers must be at least 1')
   # record the issuing command
   with open(os.path.join(args.outDir, 'command.log'), 'w') as f:
     f.write('%s' % sys.argv[0])
@@ -694,25 +1273,449 @@ def checkArguments(args, parser):
     f.write('\n')
 
 
+class FilterInputs(object):
+  """ The inputs that filters share (sequences, the original transcripts and
+  the alignments), loaded from ARGS the first time they are asked for and
+  kept so that filters run in the same process only parse them once.
+  """
+  # inputs that depend only on the reference, see shareReference()
+  _referenceInputs = ('refSequences', 'originalTranscripts',
+                      'originalTranscriptsDict')
+
+  def __init__(self, args):
+    self.args = args
+    self._cache = {}
+
+  def shareReference(self, other):
+    """ Use the reference inputs (refSequence and the original transcripts)
+    already loaded by OTHER, a FilterInputs for the same reference, rather
+    than loading them again. i.e. to load them once for many genomes.
+    """
+    for name in self._referenceInputs:
+      if name in other._cache:
+        self._cache[name] = other._cache[name]
+
+  def _get(self, name, loader):
+    if name not in self._cache:
+      self._cache[name] = loader()
+    return self._cache[name]
+
+  def getSequences(self):
+    """ dict of the genome's sequences, uppercase, keyed by name.
+    """
+    return self._get('sequences', lambda: getSequences(
+        self.args.sequence, upper=True, lazy=True))
+
+  def getNRunIndex(self):
+    """ NRunIndex of the genome's sequences.
+    """
+    return self._get('nRunIndex', lambda: NRunIndex(self.getSequences()))
+
+  def getRefSequences(self):
+    """ dict of the reference genome's sequences, uppercase, keyed by name.
+    """
+    return self._get('refSequences', lambda: getSequences(
+        self.args.refSequence, upper=True, lazy=True))
+
+  def getOriginalTranscripts(self):
+    """ list of the reference's Transcript objects.
+    """
+    return self._get('originalTranscripts', lambda: getTranscripts(
+        self.args.originalGeneCheckBed, self.args.originalGeneCheckBedDetails))
+
+  def getOriginalTranscriptsDict(self):
+    """ dict of the reference's Transcript objects keyed by name.
+    """
+    return self._get('originalTranscriptsDict', lambda: transcriptListToDict(
+        self.getOriginalTranscripts(), noDuplicates=True))
+
+  def getAlignmentIndex(self):
+    """ AlignmentIndex of the alignment, see getAlignmentIndex().
+    """
+    return self._get('alignmentIndex',
+                     lambda: getAlignmentIndex(self.args.alignment))
+
+  def getAlignments(self):
+    """ list of the PslRow objects from the alignment.
+    """
+    return self._get('alignments', lambda: self.getAlignmentIndex().rows())
+
+  def getAlignmentsDict(self):
+    """ dict of lists of PslRow objects keyed by (qName, tName).
+    """
+    return self.getAlignmentIndex().byQueryTarget()
+
+  def getAlignmentsHashkeyDict(self):
+    """ dict of lists of PslRow objects keyed by PslRow.hashkey().
+    """
+    return self.getAlignmentIndex().byHashkey()
+
+  def getMemoStore(self, filterFile):
+    """ MemoStore for the filter whose source is FILTERFILE in args.memoDb,
+    or None if there is no --memoDb. Filters share one connection.
+    """
+    if getattr(self.args, 'memoDb', None) is None:
+      return None
+    connection = self._get('memoConnection',
+                           lambda: MemoStore.connect(self.args.memoDb))
+    return MemoStore(connection, filterFile)
+
+
+def runFilter(filterTranscripts, extraArguments=None, extraChecks=None):
+  """ The main() of a filter. FILTERTRANSCRIPTS(transcripts, args, inputs) is
+  a generator that takes an iterator of Transcript objects, the args and a
+  FilterInputs object and yields the filtered Transcript objects (filters
+  that need to see every transcript first may return a list instead). The
+  transcripts are streamed from args.geneCheckBed and args.geneCheckBedDetails
+  and the results written to args.outDir with writeAllBeds(). Returns args.
+  """
+  args = boilerplateArguments(extraArguments, extraChecks)
+  inputs = FilterInputs(args)
+  transcripts = iterTranscripts(args.geneCheckBed, args.geneCheckBedDetails,
+                                sortedStreams=args.sortedInput)
+  writeAllBeds(filterTranscripts(transcripts, args, inputs), args)
+  return args
+
+
+_sourceDigests = {}  # see _sourceDigest()
+def _sourceDigest(path):
+  """ sha1 hex digest of the python source file PATH (rather than of its .pyc).
+  """
+  path = os.path.splitext(os.path.abspath(path))[0]
+  if not os.path.exists(path):
+    path += '.py'
+  if path not in _sourceDigests:
+    with open(path, 'rb') as f:
+      _sourceDigests[path] = hashlib.sha1(f.read()).hexdigest()
+  return _sourceDigests[path]
+
+
+class MemoStore(object):
+  """ The per-transcript results of a filter, kept in an sqlite database so
+  that transcripts which have not changed since an earlier run (e.g. of an
+  earlier release) are not computed again. Results are keyed by key(), the
+  sha1 of the transcript and of whatever else the result depends on, in a
+  namespace made from the sources of the filter and of lib_filter so that
+  changing either starts afresh. See memoized().
+  Several processes may share one database. Results are buffered and
+  written in one short transaction every commitInterval results, so the
+  write lock is only held while writing, never while results are computed.
+  """
+  commitInterval = 1000  # results buffered between writes
+
+  def __init__(self, connection, filterFile):
+    self.connection = connection
+    self.namespace = '%s:%s:%s' % (os.path.basename(filterFile),
+                                   _sourceDigest(filterFile),
+                                   _sourceDigest(__file__))
+    self.hits = 0
+    self.misses = 0
+    self._pending = {}  # key: value, not yet written
+
+  @staticmethod
+  def connect(path, timeout=600):
+    """ open (creating if need be) the memo database PATH. TIMEOUT is the
+    number of seconds to wait for another process's write to finish.
+    """
+    # several genomes may be run against one database at once, with a write
+    # ahead log their reads do not wait for each other's writes
+    connection = sqlite3.connect(path, timeout=timeout)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('CREATE TABLE IF NOT EXISTS memo (namespace TEXT, '
+                       'key TEXT, value BLOB, PRIMARY KEY (namespace, key))')
+    connection.commit()
+    return connection
+
+  def key(self, t, parts):
+    """ key for the result for transcript T, its annotations and PARTS, a
+    list of strings that the result also depends on.
+    """
+    h = hashlib.sha1(t.bedString())
+    for a in t.annotations:
+      h.update('\n%s' % a.bedString())
+    for part in parts:
+      h.update('\0%s' % (part,))
+    return h.hexdigest()
+
+  def get(self, key):
+    """ the value stored under KEY, or None.
+    """
+    if key in self._pending:
+      value = self._pending[key]
+    else:
+      row = self.connection.execute(
+        'SELECT value FROM memo WHERE namespace = ? AND key = ?',
+        (self.namespace, key)).fetchone()
+      if row is None:
+        self.misses += 1
+        return None
+      value = row[0]
+    self.hits += 1
+    return marshal.loads(str(value))
+
+  def put(self, key, value):
+    """ store VALUE, anything marshal can dump, under KEY. It is written to
+    the database by the next commit().
+    """
+    self._pending[key] = buffer(marshal.dumps(value))
+    if len(self._pending) >= self.commitInterval:
+      self.commit()
+
+  def commit(self):
+    """ write the buffered results in one transaction.
+    """
+    if self._pending:
+      self.connection.executemany(
+        'INSERT OR REPLACE INTO memo VALUES (?, ?, ?)',
+        [(self.namespace, key, value)
+         for key, value in self._pending.iteritems()])
+      self._pending = {}
+    self.connection.commit()
+
+
+def transcriptToRecord(t):
+  """ Transcript T, with its annotations, as a tuple that marshal can dump.
+  See recordToTranscript().
+  """
+  return (t.bedString(),
+          [(a.chromosomeInterval.chromosome, a.chromosomeInterval.start,
+            a.chromosomeInterval.stop, a.chromosomeInterval.strand, a.name,
+            list(a.labels), a._itemRgb) for a in t.annotations])
+
+
+def recordToTranscript(record):
+  """ The Transcript from a transcriptToRecord() RECORD.
+  """
+  bed, annotations = record
+  t = _makeTranscript(bed.split('\t'), {})
+  for chrom, start, stop, strand, name, labels, itemRgb in annotations:
+    a = TranscriptAnnotation(ChromosomeInterval(chrom, start, stop, strand),
+                             name, labels)
+    a._itemRgb = itemRgb
+    t.annotations.append(a)
+  return t
+
+
+def memoized(memo, t, compute, keyParts):
+  """ Return (transcript, result) for COMPUTE(T), which may modify transcript
+  T and returns a result that marshal can dump. KEYPARTS(T) is the list of
+  strings, besides T and its annotations, that COMPUTE depends on. If MEMO,
+  a MemoStore, is None COMPUTE is just called. Otherwise if MEMO has a result
+  for the same key the transcript as COMPUTE left it and the result are taken
+  from MEMO, rather than calling COMPUTE, and if not they are stored in MEMO.
+  """
+  if memo is None:
+    return t, compute(t)
+  key = memo.key(t, keyParts(t))
+  value = memo.get(key)
+  if value is not None:
+    record, result = value
+    return recordToTranscript(record), result
+  result = compute(t)
+  memo.put(key, (transcriptToRecord(t), result))
+  return t, result
+
+
+def memoizedBatch(memo, transcripts, compute, keyParts):
+  """ memoized() for the list TRANSCRIPTS, for filters that compute many
+  transcripts at once. COMPUTE(transcripts) is called once, with the
+  transcripts that MEMO has no result for, and returns the list of their
+  results. Returns the list of (transcript, result) in the order of
+  TRANSCRIPTS.
+  """
+  if memo is None:
+    return zip(transcripts, compute(transcripts))
+  keys = [memo.key(t, keyParts(t)) for t in transcripts]
+  values = [memo.get(key) for key in keys]
+  missing = [t for t, value in zip(transcripts, values) if value is None]
+  results = iter(compute(missing) if missing else [])
+  pairs = []
+  for t, key, value in zip(transcripts, keys, values):
+    if value is None:
+      result = next(results)
+      memo.put(key, (transcriptToRecord(t), result))
+      pairs.append((t, result))
+    else:
+      record, result = value
+      pairs.append((recordToTranscript(record), result))
+  return pairs
+
+
+def exonSequence(t, seq_dict):
+  """ The concatenated + strand sequence of the exons of transcript T from
+  SEQ_DICT, or None if SEQ_DICT does not have T's chromosome. For MemoStore
+  keys of results that depend on T's sequence.
+  """
+  if t.chromosomeInterval.chromosome not in seq_dict:
+    return None
+  sequence = seq_dict[t.chromosomeInterval.chromosome]
+  return ''.join(sequence._slice(e.start, e.stop) for e in t.exons)
+
+
+PARALLEL_CHUNK_SIZE = 256  # most transcripts sent to a worker at once
+_parallelFunctions = {}  # see mapTranscripts(), inherited by the workers
+
+
+def mapTranscripts(transcripts, function, workers=1, memo=None,
+                   keyParts=None):
+  """ Yield (transcript, result) for each of TRANSCRIPTS, in order, where
+  result is FUNCTION(transcript), which may modify the transcript, as in
+  memoized() with MEMO and KEYPARTS. With more than one of WORKERS the
+  transcripts are handed, a chromosome at a time, to a pool of that many
+  processes, forked when the first transcript is asked for, that inherit
+  whatever inputs FUNCTION uses; the results must then be picklable. The
+  transcripts and results are the same either way.
+  """
+  if workers <= 1:
+    for t in transcripts:
+      yield memoized(memo, t, function, keyParts)
+    return
+  token = id(function)
+  _parallelFunctions[token] = function
+  pool = multiprocessing.Pool(workers)
+  try:
+    pending = deque()
+    for chunk in _chromosomeChunks(transcripts, PARALLEL_CHUNK_SIZE):
+      pending.append(_submitChunk(pool, token, chunk, memo, keyParts))
+      # bound the transcripts held in memory
+      while len(pending) > 2 * workers:
+        for pair in _collectChunk(pending.popleft(), memo):
+          yield pair
+    while pending:
+      for pair in _collectChunk(pending.popleft(), memo):
+        yield pair
+  finally:
+    pool.terminate()
+    pool.join()
+    del _parallelFunctions[token]
+
+
+def _chromosomeChunks(transcripts, chunkSize):
+  """ Split TRANSCRIPTS into lists of at most CHUNKSIZE consecutive
+  transcripts on the same chromosome.
+  """
+  for chrom, group in groupby(
+      transcripts, key=lambda t: t.chromosomeInterval.chromosome):
+    chunk = []
+    for t in group:
+      chunk.append(t)
+      if len(chunk) == chunkSize:
+        yield chunk
+        chunk = []
+    if chunk:
+      yield chunk
+
+
+def _submitChunk(pool, token, chunk, memo, keyParts):
+  """ Start the work of mapTranscripts() on the transcripts of CHUNK that
+  MEMO does not have, returning what _collectChunk() needs to finish it.
+  """
+  entries = []  # (key, (record, result) or None) for each transcript
+  records = []  # transcriptToRecord() of the transcripts to compute
+  for t in chunk:
+    key = value = None
+    if memo is not None:
+      key = memo.key(t, keyParts(t))
+      value = memo.get(key)
+    if value is None:
+      records.append(transcriptToRecord(t))
+    entries.append((key, value))
+  job = None
+  if records:
+    job = pool.apply_async(_mapChunk, (token, records))
+  return entries, job
+
+
+def _collectChunk(submitted, memo):
+  """ Yield the (transcript, result) pairs of a _submitChunk(), storing the
+  computed ones in MEMO.
+  """
+  entries, job = submitted
+  computed = iter(job.get() if job is not None else [])
+  for key, value in entries:
+    if value is None:
+      value = next(computed)
+      if memo is not None:
+        memo.put(key, value)
+    record, result = value
+    yield recordToTranscript(record), result
+
+
+def _mapChunk(token, records):
+  """ Run in a worker of mapTranscripts(): apply its function to each of the
+  transcriptToRecord() RECORDS, returning (record, result) pairs.
+  """
+  function = _parallelFunctions[token]
+  results = []
+  for record in records:
+    t = recordToTranscript(record)
+    result = function(t)
+    results.append((transcriptToRecord(t), result))
+  return results
+
+
 _nuc_pairs = [('a', 't'), ('g', 'c'), ('n', 'n')]
-_complement = {}
-for a, b in _nuc_pairs:
-  _complement[a], _complement[b] = b, a
-  _complement[a.upper()], _complement[b.upper()] = b.upper(), a.upper()
-_complement['-'] = '-'
+_complementFrom = ''.join(a + b + a.upper() + b.upper() for a, b in _nuc_pairs)
+_complementTo = ''.join(b + a + b.upper() + a.upper() for a, b in _nuc_pairs)
+_complementFrom += '-'
+_complementTo += '-'
+_complementTable = string.maketrans(_complementFrom, _complementTo)
 def complement(seq):
-  """ given a sequence, return the complement.
+  """ given a sequence, return the complement. Raises a KeyError for
+  characters other than acgtn, ACGTN and -.
   """
-  seq = ''.join([_complement[s] for s in seq])
-  return seq
+  unknown = seq.translate(None, _complementFrom)
+  if unknown:
+    raise KeyError(unknown[0])
+  return seq.translate(_complementTable)
 
 
 def reverseComplement(seq):
   """ Given a sequence, return the reverse complement.
   """
-  seq = seq[::-1]  # reverse
-  seq = complement(seq)
-  return seq
+  return complement(seq[::-1])
+
+
+def getMRnas(transcripts, sequence):
+  """ Return the mRNAs of TRANSCRIPTS, all on the chromosome of the Sequence
+  SEQUENCE, as (buffer, offsets) where buffer[offsets[i]:offsets[i + 1]] is
+  transcripts[i].getMRna(sequence). The slices of all of the transcripts are
+  read in a single pass and the - strand mRNAs are reverse complemented all
+  at once.
+  """
+  lengths = numpy.zeros(len(transcripts), dtype=numpy.int64)
+  plus, minus = [], []  # slices of the + and - strand transcripts
+  for i, t in enumerate(transcripts):
+    assert(t.chromosomeInterval.chromosome == sequence.name)
+    assert(t.chromosomeInterval.stop <= sequence.getLength())
+    tSlices = t.getMRnaSlices()
+    lengths[i] = sum(stop - start for start, stop in tSlices)
+    if t.chromosomeInterval.strand:
+      plus.extend(tSlices)
+    else:
+      minus.append(tSlices)
+  offsets = numpy.zeros(len(transcripts) + 1, dtype=numpy.int64)
+  numpy.cumsum(lengths, out=offsets[1:])
+  plusBuffer = ''.join([sequence._slice(start, stop) for start, stop in plus])
+  if not minus:
+    return plusBuffer, offsets
+  # the last transcript first, so that reversing them all at once leaves
+  # them in order
+  minusBuffer = reverseComplement(''.join([
+    sequence._slice(start, stop)
+    for tSlices in reversed(minus) for start, stop in tSlices]))
+  if not plus:
+    return minusBuffer, offsets
+  pieces = []
+  plusOffset = minusOffset = 0
+  for t, length in zip(transcripts, lengths.tolist()):
+    if t.chromosomeInterval.strand:
+      pieces.append(plusBuffer[plusOffset:plusOffset + length])
+      plusOffset += length
+    else:
+      pieces.append(minusBuffer[minusOffset:minusOffset + length])
+      minusOffset += length
+  return ''.join(pieces), offsets
 
 
 _codonToAminoAcid = {
@@ -752,13 +1755,60 @@ def codonToAminoAcid(c):
   return '???'
 
 
+# the nucleotides (plus N) and IUPAC ambiguity characters that appear in the
+# codons of _codonToAminoAcid, every other character is coded as len(_iupac).
+_iupac = 'ACGTNRYSWKMBDHV'
+_nucleotideCodes = numpy.empty(256, dtype=numpy.int16)
+_nucleotideCodes.fill(len(_iupac))
+for i, n in enumerate(_iupac):
+  _nucleotideCodes[ord(n)] = _nucleotideCodes[ord(n.lower())] = i
+_codonBase = len(_iupac) + 1
+AMINO_ACIDS = sorted(set(_codonToAminoAcid.values())) + ['???']
+_aminoAcidNames = numpy.array(AMINO_ACIDS, dtype=object)
+_codonCodes = numpy.empty(_codonBase ** 3, dtype=numpy.int8)
+_codonCodes.fill(AMINO_ACIDS.index('???'))
+for c, aa in _codonToAminoAcid.items():
+  _codonCodes[(_nucleotideCodes[ord(c[0])] * _codonBase
+               + _nucleotideCodes[ord(c[1])]) * _codonBase
+              + _nucleotideCodes[ord(c[2])]] = AMINO_ACIDS.index(aa)
+
+
+def translateCodons(seq):
+  """ Translate every codon of SEQ at once, returning a numpy array of
+  indices into AMINO_ACIDS with one element per codon of readCodons(SEQ),
+  i.e. AMINO_ACIDS[translateCodons(seq)[i]] is codonToAminoAcid() of the
+  ith codon and a trailing partial codon is '???'.
+  """
+  seq += '-' * (-len(seq) % 3)
+  codes = _nucleotideCodes[numpy.frombuffer(seq, dtype=numpy.uint8)]
+  codes = codes.reshape(-1, 3)
+  return _codonCodes[(codes[:, 0] * _codonBase + codes[:, 1]) * _codonBase
+                     + codes[:, 2]]
+
+
+def translateSequences(seqs):
+  """ Translate each of the sequences SEQS, in a single pass over their
+  concatenation, returning a list of translateCodons() arrays, one per
+  sequence, that are views into one array.
+  """
+  padded = [s + '-' * (-len(s) % 3) for s in seqs]
+  bounds = numpy.zeros(len(padded) + 1, dtype=numpy.int64)
+  numpy.cumsum([len(s) // 3 for s in padded], out=bounds[1:])
+  codes = translateCodons(''.join(padded))
+  return [codes[bounds[i]:bounds[i + 1]] for i in xrange(len(padded))]
+
+
+def codonsToAminoAcids(seq):
+  """ Return the list of amino acids of the codons of SEQ, the same as
+  [codonToAminoAcid(c) for c in readCodons(seq)] but translated at once.
+  """
+  return _aminoAcidNames[translateCodons(seq)].tolist()
+
+
 def translateSequence(seq):
   """ Convert an entire DNA sequence to an amino acid sequence.
   """
-  aa = ''
-  for i in xrange(0, len(seq), 3):
-    aa += codonToAminoAcid(seq[i:i+3])
-  return aa
+  return ''.join(codonsToAminoAcids(seq))
 
 
 def readCodons(seq):
@@ -771,61 +1821,307 @@ def readCodons(seq):
     yield t
 
 
-def getSequences(infile, upper=False):
+def getSequences(infile, upper=False, lazy=False):
   """ Given a path to a fasta file, return a dictionary of Sequence objects
-  keyed on the sequence name.
+  keyed on the sequence name. If an up to date .2bit cache of the fasta
+  exists (see fastaToTwoBit()) it is opened instead and TwoBitSequence objects
+  are returned. Otherwise, if LAZY is true, the file is memory mapped and
+  MappedSequence objects are returned, falling back to reading the whole file
+  if it cannot be indexed (i.e. it has irregular line lengths).
   """
+  twoBit = findTwoBit(infile)
+  if twoBit is not None:
+    return getTwoBitSequences(twoBit, upper=upper)
+  if lazy:
+    try:
+      return getMappedSequences(infile, upper=upper)
+    except FastaIndexError:
+      pass
   seqDict = {}
-  seq = None
   with open(infile, 'r') as f:
-    for seq in readSequence(f):
+    for seq in readSequence(f, upper=upper):
       seqDict[seq.name] = seq
-      if upper:
-        seqDict[seq.name].setUpper()
   return seqDict
 
 
-def readSequence(infile):
-  """ provide an iterator that reads through fasta files.
+def readSequence(infile, upper=False):
+  """ provide an iterator that reads through fasta files. Lines of a record
+  are collected and joined once, so parsing is linear in the record size.
+  If UPPER is true lines are uppercased as they are read, which avoids a
+  second full copy of the sequence.
   """
-  buff = None
-  eat_buffer = True
-  while True:
-    if eat_buffer:
-      # new record
-      if buff is None:
-        header = ''
-        while not header.startswith('>'):
-          header = infile.readline().strip()
-          if header == '':
-            return
-      else:
-        header = buff
-      assert(header.startswith('>'))
-      name = header.replace('>', '').strip().split(" ")[0]
-      seq = ''
-    line = infile.readline().strip()
-    if line:
+  name = None
+  lines = []
+  for line in infile:
+    if line.startswith('>'):
+      if name is not None:
+        yield Sequence(name, ''.join(lines))
+      name = line.replace('>', '').strip().split(' ')[0]
+      lines = []
+      continue
+    line = line.strip()
+    if line and name is not None:
+      if upper:
+        line = line.upper()
+      lines.append(line)
+  if name is not None:
+    yield Sequence(name, ''.join(lines))
+
+
+class FastaIndexError(Exception):
+  """ Raised when a fasta file cannot be described by a .fai style index.
+  """
+  pass
+
+
+def buildFastaIndex(infile):
+  """ Scan the fasta file INFILE and return a list of index entries, one
+  tuple per record: (name, length, offset, lineBases, lineWidth), which are
+  the same five columns as a samtools .fai file. Raises FastaIndexError if a
+  record has lines of differing lengths (other than its last line).
+  """
+  index = []
+  record = None
+
+  def finish(record):
+    name, length, offset, lineBases, lineWidth, shortLine = record
+    if lineBases is None:
+      lineBases, lineWidth = 1, 1  # empty record, any values will do
+    return (name, length, offset, lineBases, lineWidth)
+
+  pos = 0
+  with open(infile, 'rb') as f:
+    for line in f:
+      pos += len(line)
       if line.startswith('>'):
-        # stop processing the record, store this line.
-        buff = line
-        eat_buffer = True
-        yield Sequence(name, seq)
-      else:
-        eat_buffer = False
-        seq += line
-    else:
-      # eof
-      if buff is not None:
-        buff = None
-        yield Sequence(name, seq)
-      else:
-        if seq != '':
-          yield Sequence(name, seq)
-          name = ''
-          seq = ''
-        else:
-          return
+        if record is not None:
+          index.append(finish(record))
+        name = line.replace('>', '').strip().split(' ')[0]
+        # name, length, offset, lineBases, lineWidth, seenShortLine
+        record = [name, 0, pos, None, None, False]
+        continue
+      bases = len(line.rstrip('\r\n'))
+      eol = len(line) - bases  # 0 only for a final line lacking a newline
+      if record is None:
+        if line.strip() == '':
+          continue
+        raise FastaIndexError('%s: sequence data before first header'
+                              % infile)
+      if bases == 0:
+        record[5] = True
+        continue
+      if line.strip() != line.rstrip('\r\n'):
+        raise FastaIndexError('%s: record %s contains whitespace'
+                              % (infile, record[0]))
+      if record[5]:
+        raise FastaIndexError('%s: record %s has irregular line lengths'
+                              % (infile, record[0]))
+      if record[3] is None:
+        record[3], record[4] = bases, len(line)
+      elif (bases > record[3] or
+            (eol and eol != record[4] - record[3])):
+        raise FastaIndexError('%s: record %s has irregular line lengths'
+                              % (infile, record[0]))
+      if bases < record[3] or not eol:
+        record[5] = True
+      record[1] += bases
+  if record is not None:
+    index.append(finish(record))
+  return index
+
+
+def getFastaIndex(infile):
+  """ Return the index entries for fasta INFILE (see buildFastaIndex()).
+  An up to date INFILE.fai is read if present, otherwise the index is built
+  and an attempt is made to store it as INFILE.fai for the next caller.
+  """
+  faiFile = infile + '.fai'
+  if (os.path.exists(faiFile) and
+      os.path.getmtime(faiFile) >= os.path.getmtime(infile)):
+    index = []
+    with open(faiFile, 'r') as f:
+      for line in f:
+        data = line.split()
+        if not data:
+          continue
+        index.append((data[0],) + tuple(int(x) for x in data[1:5]))
+    return index
+  index = buildFastaIndex(infile)
+  try:
+    with open(faiFile, 'w') as f:
+      for entry in index:
+        f.write('%s\t%d\t%d\t%d\t%d\n' % entry)
+  except (IOError, OSError):
+    pass  # read only location, keep the index in memory only.
+  return index
+
+
+def getMappedSequences(infile, upper=False):
+  """ Given a path to a fasta file, return a dictionary of MappedSequence
+  objects keyed on the sequence name. The file is memory mapped, nothing is
+  read until it is sliced.
+  """
+  index = getFastaIndex(infile)
+  seqDict = {}
+  if not index:
+    return seqDict
+  with open(infile, 'rb') as f:
+    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  for name, length, offset, lineBases, lineWidth in index:
+    seqDict[name] = MappedSequence(name, length, mapped, offset,
+                                   lineBases, lineWidth, upper=upper)
+  return seqDict
+
+
+_twoBitSignature = 0x1A412743
+# 2bit encodes T, C, A, G as 0, 1, 2, 3. Row i of the table holds the four
+# nucleotides packed into the byte value i.
+_twoBitDecode = numpy.array(
+  [[ord('TCAG'[(i >> shift) & 3]) for shift in (6, 4, 2, 0)]
+   for i in xrange(256)], dtype=numpy.uint8)
+_twoBitEncode = numpy.zeros(256, dtype=numpy.uint8)
+for _i, _c in enumerate('TCAG'):
+  _twoBitEncode[ord(_c)] = _i
+  _twoBitEncode[ord(_c.lower())] = _i
+
+
+class TwoBitError(Exception):
+  """ Raised for .2bit files that cannot be read, or sequences that cannot be
+  represented in one.
+  """
+  pass
+
+
+def _blockMask(start, stop, blocks):
+  """ return a boolean array over [START, STOP) that is true for positions
+  inside BLOCKS, a sorted (starts, ends) pair of arrays, or None if no block
+  overlaps the range.
+  """
+  starts, ends = blocks
+  i = numpy.searchsorted(ends, start, side='right')
+  j = numpy.searchsorted(starts, stop, side='left')
+  if i >= j:
+    return None
+  # blocks do not overlap, so at most one block opens or closes at a position
+  length = stop - start + 1
+  delta = (
+    numpy.bincount(numpy.maximum(starts[i:j], start) - start,
+                   minlength=length) -
+    numpy.bincount(numpy.minimum(ends[i:j], stop) - start, minlength=length))
+  return numpy.cumsum(delta[:-1]) > 0
+
+
+def _runs(isRun):
+  """ return the (starts, sizes) arrays of the runs of true values in the
+  boolean array ISRUN.
+  """
+  edges = numpy.diff(numpy.concatenate(([0], isRun.view(numpy.int8), [0])))
+  starts = numpy.flatnonzero(edges == 1)
+  ends = numpy.flatnonzero(edges == -1)
+  return starts, ends - starts
+
+
+_notTwoBitPattern = re.compile('[^ACGTNacgtn]')
+
+
+def writeTwoBit(sequences, outfile):
+  """ Write the Sequence objects in SEQUENCES (an iterable) to OUTFILE in the
+  UCSC .2bit format. Raises TwoBitError if a sequence contains characters
+  other than ACGTN (in either case), since 2bit would turn them into Ns.
+  """
+  records = []
+  for seq in sequences:
+    s = seq.getSequence()
+    m = _notTwoBitPattern.search(s)
+    if m is not None:
+      raise TwoBitError('%s contains %r at %d, which 2bit cannot represent'
+                        % (seq.name, m.group(), m.start()))
+    chars = numpy.frombuffer(s, dtype=numpy.uint8)
+    nRuns = _runs((chars == ord('N')) | (chars == ord('n')))
+    maskRuns = _runs(chars >= ord('a'))  # only acgtn remain at this point
+    codes = _twoBitEncode[chars]
+    codes = numpy.concatenate(
+      (codes, numpy.zeros(-len(codes) % 4, dtype=numpy.uint8))).reshape(-1, 4)
+    packed = (codes[:, 0] << 6 | codes[:, 1] << 4 |
+              codes[:, 2] << 2 | codes[:, 3]).astype(numpy.uint8)
+    records.append((seq.name, len(s), nRuns, maskRuns, packed.tostring()))
+  offset = 16 + sum(1 + len(r[0]) + 4 for r in records)
+  with open(outfile, 'wb') as f:
+    f.write(struct.pack('<IIII', _twoBitSignature, 0, len(records), 0))
+    for name, length, nRuns, maskRuns, packed in records:
+      f.write(struct.pack('<B', len(name)) + name + struct.pack('<I', offset))
+      offset += (4 + 4 + 8 * len(nRuns[0]) + 4 + 8 * len(maskRuns[0]) + 4 +
+                 len(packed))
+    if offset >= 2 ** 32:
+      raise TwoBitError('%s would exceed the 4GB limit of 2bit version 0'
+                        % outfile)
+    for name, length, nRuns, maskRuns, packed in records:
+      f.write(struct.pack('<I', length))
+      for starts, sizes in (nRuns, maskRuns):
+        f.write(struct.pack('<I', len(starts)))
+        f.write(starts.astype('<u4').tostring())
+        f.write(sizes.astype('<u4').tostring())
+      f.write(struct.pack('<I', 0))
+      f.write(packed)
+
+
+def fastaToTwoBit(infile, outfile=None):
+  """ Convert the fasta INFILE to a .2bit cache that getSequences() will find
+  and prefer from then on. OUTFILE defaults to getTwoBitPath(INFILE).
+  """
+  if outfile is None:
+    outfile = getTwoBitPath(infile)
+  with open(infile, 'r') as f:
+    writeTwoBit(readSequence(f), outfile)
+  return outfile
+
+
+def getTwoBitPath(infile):
+  """ return the path of the .2bit cache for the fasta INFILE.
+  """
+  return os.path.splitext(infile)[0] + '.2bit'
+
+
+def findTwoBit(infile):
+  """ return the path of an up to date .2bit cache for fasta INFILE, if
+  there is one, otherwise None. INFILE may itself be a .2bit file.
+  """
+  if infile.endswith('.2bit'):
+    return infile
+  twoBit = getTwoBitPath(infile)
+  if (os.path.exists(twoBit) and
+      os.path.getmtime(twoBit) >= os.path.getmtime(infile)):
+    return twoBit
+  return None
+
+
+def getTwoBitSequences(infile, upper=False):
+  """ Given a path to a .2bit file, return a dictionary of TwoBitSequence
+  objects keyed on the sequence name.
+  """
+  seqDict = {}
+  with open(infile, 'rb') as f:
+    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  for endian in '<>':
+    signature, version, count, reserved = struct.unpack_from(
+      endian + 'IIII', mapped, 0)
+    if signature == _twoBitSignature:
+      break
+  else:
+    raise TwoBitError('%s is not a 2bit file' % infile)
+  if version not in (0, 1):
+    raise TwoBitError('%s has unknown 2bit version %d' % (infile, version))
+  offsetFormat = endian + ('I' if version == 0 else 'Q')
+  pos = 16
+  for i in xrange(count):
+    nameSize = ord(mapped[pos])
+    name = mapped[pos + 1:pos + 1 + nameSize]
+    pos += 1 + nameSize
+    recordOffset = struct.unpack_from(offsetFormat, mapped, pos)[0]
+    pos += struct.calcsize(offsetFormat)
+    seqDict[name] = TwoBitSequence(name, mapped, recordOffset, endian,
+                                   upper=upper)
+  return seqDict
 
 
 def getChromSizes(infile):
@@ -862,18 +2158,334 @@ def readPsls(infile):
     yield PslRow(line)
 
 
-def getTranscripts(bedFile, bedDetailsFile):
+class PslTable(object):
+  """ The rows of a PSL file held column by column in numpy arrays, far more
+  compact than a list of PslRows: the integer columns as int32 in one column
+  major array, the strands, the names as codes into tables of the unique
+  names and the blocks of all of the rows concatenated into flat arrays
+  indexed by blockOffsets. row() gives a PslTableRow, a view of a row with the
+  PslRow API. A table can be saved and loaded again (see pslToIndex()) far
+  faster than parsing the PSL.
+  """
+  version = 2  # of the saved format
+  intColumns = ('matches', 'misMatches', 'repMatches', 'nCount',
+                'qNumInsert', 'qBaseInsert', 'tNumInsert', 'tBaseInsert',
+                'qSize', 'qStart', 'qEnd', 'tSize', 'tStart', 'tEnd',
+                'blockCount')
+  arrayNames = ('ints', 'strand', 'qNames', 'qCodes', 'tNames', 'tCodes',
+                'blockOffsets', 'blockSizes', 'qStarts', 'tStarts')
+
+  def __init__(self, arrays):
+    for name in self.arrayNames:
+      setattr(self, name, arrays[name])
+    self.qNameList = self.qNames.tolist()
+    self.tNameList = self.tNames.tolist()
+
+  @classmethod
+  def fromPsl(cls, infile):
+    """ parse the PSL file INFILE, a whole column at a time.
+    """
+    with open(infile, 'r') as f:
+      text = f.read()
+    # like readPsls(), stop at the first blank line
+    if not text.split('\n', 1)[0].strip():
+      text = ''
+    blank = re.search(r'\n[ \t\r]*\n', text)
+    if blank is not None:
+      text = text[:blank.start() + 1]
+    numRows = text.count('\n') + (text != '' and not text.endswith('\n'))
+    tokens = text.split()
+    if len(tokens) != 21 * numRows:
+      raise RuntimeError('%s: the rows of a psl must have 21 fields' % infile)
+    columns = [tokens[k::21] for k in xrange(21)]
+    del tokens
+    arrays = {'ints': numpy.empty((numRows, len(cls.intColumns)),
+                                  dtype=numpy.int32, order='F')}
+    for j, k in enumerate(range(0, 8) + range(10, 13) + range(14, 18)):
+      arrays['ints'][:, j] = _parseInt32(' '.join(columns[k]), ' ', infile)
+    arrays['strand'] = numpy.array(columns[8], dtype=str)
+    for name, k in [('q', 9), ('t', 13)]:
+      names, codes = numpy.unique(numpy.array(columns[k], dtype=str),
+                                  return_inverse=True)
+      arrays[name + 'Names'] = names
+      arrays[name + 'Codes'] = codes.astype(numpy.int32)
+    blockCounts = arrays['ints'][:, cls.intColumns.index('blockCount')]
+    arrays['blockOffsets'] = numpy.concatenate(
+      ([0], numpy.cumsum(blockCounts, dtype=numpy.int64)))
+    for name, k in [('blockSizes', 18), ('qStarts', 19), ('tStarts', 20)]:
+      # the lists are usually, but not always, comma terminated
+      arrays[name] = _parseInt32(
+        ','.join(columns[k]).replace(',,', ',').strip(','), ',', infile)
+      if len(arrays[name]) != arrays['blockOffsets'][-1]:
+        raise RuntimeError('%s: the %s do not add up to the blockCounts'
+                           % (infile, name))
+    return cls(arrays)
+
+  @classmethod
+  def load(cls, path):
+    """ load a table written by save().
+    """
+    with numpy.load(path) as saved:
+      if int(saved['version']) != cls.version:
+        raise RuntimeError('%s is a saved PslTable of version %d, not %d'
+                           % (path, int(saved['version']), cls.version))
+      return cls(dict((name, saved[name]) for name in cls.arrayNames))
+
+  def save(self, path):
+    """ write the table to PATH, a numpy .npz file.
+    """
+    with open(path, 'wb') as f:
+      numpy.savez(f, version=numpy.array(self.version), **dict(
+          (name, getattr(self, name)) for name in self.arrayNames))
+
+  def __len__(self):
+    return len(self.qCodes)
+
+  def column(self, name):
+    """ numpy array of the integer column NAME, one of intColumns.
+    """
+    return self.ints[:, self.intColumns.index(name)]
+
+  def row(self, i):
+    """ PslTableRow of row I.
+    """
+    return PslTableRow(self, i)
+
+  def rows(self):
+    """ list of the PslTableRows of every row, in file order.
+    """
+    return [PslTableRow(self, i) for i in xrange(len(self))]
+
+
+def _parseInt32(text, sep, infile):
+  """ numpy int32 array of the SEP separated integers in TEXT, from INFILE.
+  """
+  values = numpy.fromstring(text, dtype=numpy.int64, sep=sep)
+  if len(values) and (values.min() < -2 ** 31 or values.max() >= 2 ** 31):
+    raise RuntimeError('%s: a value does not fit in 32 bits' % infile)
+  return values.astype(numpy.int32)
+
+
+class PslTableRow(_PslCoordinates):
+  """ A view of row I of a PslTable, with the attributes and methods of a
+  PslRow. The fields are read from the table as they are used.
+  """
+  __slots__ = ('table', 'i', '_ints', '_blockLists')  # conserve memory
+  def __init__(self, table, i):
+    self.table = table
+    self.i = i
+    self._ints = None  # the integer fields, see _getInts()
+    self._blockLists = None  # see _getBlockLists()
+
+  def _getInts(self):
+    if self._ints is None:
+      self._ints = self.table.ints[self.i].tolist()
+    return self._ints
+
+  def _getBlockArrays(self):
+    """ return (blockSizes, qStarts, tStarts) as numpy arrays, views of the
+    table's.
+    """
+    start = self.table.blockOffsets[self.i]
+    stop = self.table.blockOffsets[self.i + 1]
+    return (self.table.blockSizes[start:stop], self.table.qStarts[start:stop],
+            self.table.tStarts[start:stop])
+
+  def _getBlockLists(self):
+    if self._blockLists is None:
+      self._blockLists = tuple(a.tolist() for a in self._getBlockArrays())
+    return self._blockLists
+
+  @property
+  def strand(self):
+    return str(self.table.strand[self.i])
+
+  @property
+  def qName(self):
+    return self.table.qNameList[self.table.qCodes[self.i]]
+
+  @property
+  def tName(self):
+    return self.table.tNameList[self.table.tCodes[self.i]]
+
+  @property
+  def blockSizes(self):
+    return self._getBlockLists()[0]
+
+  @property
+  def qStarts(self):
+    return self._getBlockLists()[1]
+
+  @property
+  def tStarts(self):
+    return self._getBlockLists()[2]
+
+# the integer fields of PslTableRow, i.e. PslTableRow.qSize
+for _j, _name in enumerate(PslTable.intColumns):
+  setattr(PslTableRow, _name,
+          property(lambda self, j=_j: self._getInts()[j]))
+
+
+class AlignmentIndex(object):
+  """ The lookups that filters use into the rows of a PslTable:
+  byQueryTarget(), byName() and byHashkey(). Each is made the first time it
+  is asked for.
+  """
+  def __init__(self, table):
+    self.table = table
+    self._groups = {}
+
+  @classmethod
+  def fromPsl(cls, infile):
+    """ parse the PSL file INFILE.
+    """
+    return cls(PslTable.fromPsl(infile))
+
+  @classmethod
+  def load(cls, path):
+    """ load an index written by save().
+    """
+    return cls(PslTable.load(path))
+
+  def save(self, path):
+    """ write the index to PATH, a numpy .npz file.
+    """
+    self.table.save(path)
+
+  def __len__(self):
+    return len(self.table)
+
+  def column(self, name):
+    return self.table.column(name)
+
+  def row(self, i):
+    return self.table.row(i)
+
+  def rows(self):
+    return self.table.rows()
+
+  def _rowGroups(self, name, makeKeys):
+    """ AlignmentGroups of the rows keyed by the list MAKEKEYS() returns,
+    which has a key for every row. Made once and kept under NAME.
+    """
+    if name not in self._groups:
+      groups = {}
+      for i, key in enumerate(makeKeys()):
+        groups.setdefault(key, []).append(i)
+      self._groups[name] = AlignmentGroups(self, dict(
+          (key, numpy.array(rows, dtype=numpy.int64))
+          for key, rows in groups.iteritems()))
+    return self._groups[name]
+
+  def _pairs(self):
+    """ list of the (qName, tName) of every row.
+    """
+    return zip([self.table.qNameList[c] for c in self.table.qCodes.tolist()],
+               [self.table.tNameList[c] for c in self.table.tCodes.tolist()])
+
+  def byQueryTarget(self):
+    """ AlignmentGroups keyed by (qName, tName).
+    """
+    return self._rowGroups('queryTarget', self._pairs)
+
+  def byName(self):
+    """ AlignmentGroups keyed by '%s_%s' % (qName, tName).
+    """
+    return self._rowGroups(
+      'name', lambda: ['%s_%s' % pair for pair in self._pairs()])
+
+  def byHashkey(self):
+    """ AlignmentGroups keyed by PslRow.hashkey().
+    """
+    return self._rowGroups('hashkey', lambda: [
+        '%s_%s_%d_%d' % (q, t, tStart, tEnd) for (q, t), tStart, tEnd in zip(
+          self._pairs(), self.column('tStart').tolist(),
+          self.column('tEnd').tolist())])
+
+
+class AlignmentGroups(object):
+  """ A read only dict of lists of the PslTableRows of an AlignmentIndex, see
+  AlignmentIndex.byQueryTarget(). The rows are made when asked for.
+  """
+  def __init__(self, index, groups):
+    self.index = index
+    self.groups = groups  # key: numpy array of row numbers
+
+  def __len__(self):
+    return len(self.groups)
+
+  def __contains__(self, key):
+    return key in self.groups
+
+  def __iter__(self):
+    return iter(self.groups)
+
+  def keys(self):
+    return self.groups.keys()
+
+  def __getitem__(self, key):
+    return [self.index.row(i) for i in self.groups[key].tolist()]
+
+  def get(self, key, default=None):
+    if key not in self.groups:
+      return default
+    return self[key]
+
+
+def pslToIndex(infile, outfile=None):
+  """ Save the AlignmentIndex of the PSL INFILE where getAlignmentIndex() will
+  find and prefer it from then on. OUTFILE defaults to
+  getAlignmentIndexPath(INFILE).
+  """
+  if outfile is None:
+    outfile = getAlignmentIndexPath(infile)
+  AlignmentIndex.fromPsl(infile).save(outfile)
+  return outfile
+
+
+def getAlignmentIndexPath(infile):
+  """ return the path of the saved AlignmentIndex for the PSL INFILE.
+  """
+  return os.path.splitext(infile)[0] + '.psl.npz'
+
+
+def getAlignmentIndex(infile):
+  """ return the AlignmentIndex of the PSL INFILE, loading the saved one if
+  it is newer than INFILE and parsing INFILE otherwise.
+  """
+  saved = getAlignmentIndexPath(infile)
+  if (os.path.exists(saved) and
+      os.path.getmtime(saved) >= os.path.getmtime(infile)):
+    try:
+      return AlignmentIndex.load(saved)
+    except RuntimeError:
+      pass  # saved in an older format
+  return AlignmentIndex.fromPsl(infile)
+
+
+def getTranscripts(bedFile, bedDetailsFile, sortedStreams=False):
   """ Given a path to a standard BED file and a details BED, return a list of
-  Transcript objects.
+  Transcript objects. See transcriptIterator() for SORTEDSTREAMS.
   """
   transcripts = []
-  bf = open(bedFile, 'r')
-  bdf = open(bedDetailsFile, 'r')
-  for t in transcriptIterator(bf, bdf):
-    transcripts.append(t)
+  with open(bedFile, 'r') as bf:
+    with open(bedDetailsFile, 'r') as bdf:
+      for t in transcriptIterator(bf, bdf, sortedStreams=sortedStreams):
+        transcripts.append(t)
   return transcripts
 
 
+def iterTranscripts(bedFile, bedDetailsFile, sortedStreams=False):
+  """ Given a path to a standard BED file and a details BED, iterate over the
+  Transcript objects. See transcriptIterator() for SORTEDSTREAMS, with it
+  only one chromosome of annotations is held in memory at a time.
+  """
+  with open(bedFile, 'r') as bf:
+    with open(bedDetailsFile, 'r') as bdf:
+      for t in transcriptIterator(bf, bdf, sortedStreams=sortedStreams):
+        yield t
+
+
 def transcriptListToDict(transcripts, noDuplicates=False):
   """ Given a list af Transcript objects, attempt to transfrom them into a dict
   of lists. key is transcript name, value is list of Transcript objects.
@@ -925,63 +2537,309 @@ def normalizeAnnotation(transcriptAnnotation):
     transcriptAnnotation.labels = newLabels
 
 
-def transcriptIterator(transcriptsBedStream, transcriptDetailsBedStream):
+def transcriptIterator(transcriptsBedStream, transcriptDetailsBedStream,
+                       sortedStreams=False):
   """ Iterates over the transcripts detailed in the two streams, producing
   Transcript objects. Streams are any iterator that returns bedlines or empty
   strings.
+  By default the whole details stream is read before the first transcript is
+  produced. If SORTEDSTREAMS is true both streams must be sorted by
+  chromosome (as written by writeTranscriptBedFile() and
+  writeDetailsBedFile()) and are instead read together, one chromosome at a
+  time, so only one chromosome's annotations are held in memory. In that
+  mode a RuntimeError is raised if either stream turns out not to be sorted.
   """
+  if sortedStreams:
+    for t in _mergeTranscriptIterator(transcriptsBedStream,
+                                      transcriptDetailsBedStream):
+      yield t
+    return
   transcriptsAnnotations = {}
   for tokens in tokenizeBedStream(transcriptDetailsBedStream):
-    assert (len(tokens) == 4 or len(tokens) == 9)  # 9 if it has color data.
-    tA = TranscriptAnnotation(
-      ChromosomeInterval(tokens[0], tokens[1], tokens[2], None),
-      tokens[3].split('/')[-1], tokens[3].split('/')[:-1])
-    # normalizeAnnotation(tA)  # removed this to improve xml
-    key = (tA.name, tA.chromosomeInterval.chromosome)
-    if key not in transcriptsAnnotations:
-      transcriptsAnnotations[key] = []
-    transcriptsAnnotations[key].append(tA)
-
+    _addAnnotation(tokens, transcriptsAnnotations)
+  _indexAnnotations(transcriptsAnnotations)
   for tokens in tokenizeBedStream(transcriptsBedStream):
-    assert len(tokens) == 12
-    # Transcript
-    name = tokens[3]
-    # Get the chromosome interval
-    assert tokens[5] in ['+', '-']
-    cI = ChromosomeInterval(tokens[0], tokens[1], tokens[2], tokens[5] == '+')
-    # Get the exons
-    def getExons(exonNumber, blockSizes, blockStarts):
-      assert exonNumber == len(blockSizes)
-      assert exonNumber == len(blockStarts)
-      return [ChromosomeInterval(
-          cI.chromosome, cI.start + int(blockStarts[i]),
-          cI.start + int(blockStarts[i]) + int(blockSizes[i]), cI.strand)
-              for i in range(exonNumber)]
-    exons = getExons(int(tokens[9]),
-                     tokens[10].split(','), tokens[11].split(','))
-    # Get the name annotations
-    annotations = []
-    key = (name, cI.chromosome)
-    if key in transcriptsAnnotations:
-      annotations = transcriptsAnnotations[key]
-    filteredAnnotations = []
-    for tA in annotations:
-      if cI.contains(tA.chromosomeInterval):
-        tA.chromosomeInterval.strand = cI.strand
-        filteredAnnotations.append(tA)
-    yield Transcript(
-      cI, name, exons, filteredAnnotations,
-      int(tokens[4]), int(tokens[6]),
-      int(tokens[7]), tokens[8])
+    yield _makeTranscript(tokens, transcriptsAnnotations)
+
+
+def _addAnnotation(tokens, transcriptsAnnotations):
+  """ Parse the details bed TOKENS into a TranscriptAnnotation and add it to
+  the TRANSCRIPTSANNOTATIONS dict, keyed on (name, chromosome).
+  """
+  assert (len(tokens) == 4 or len(tokens) == 9)  # 9 if it has color data.
+  tA = TranscriptAnnotation(
+    ChromosomeInterval(tokens[0], tokens[1], tokens[2], None),
+    tokens[3].split('/')[-1], tokens[3].split('/')[:-1])
+  # normalizeAnnotation(tA)  # removed this to improve xml
+  key = (tA.name, tA.chromosomeInterval.chromosome)
+  if key not in transcriptsAnnotations:
+    transcriptsAnnotations[key] = []
+  transcriptsAnnotations[key].append(tA)
+
+
+ANNOTATION_INDEX_SIZE = 32  # see _indexAnnotations()
+
+
+def _indexAnnotations(transcriptsAnnotations):
+  """ Replace the lists of TRANSCRIPTSANNOTATIONS (see _addAnnotation()) that
+  are longer than ANNOTATION_INDEX_SIZE with IntervalIndexes of them, i.e.
+  those of transcripts with many copies on a chromosome, so that
+  _makeTranscript() does not scan them all for every copy.
+  """
+  for key, annotations in transcriptsAnnotations.items():
+    if len(annotations) > ANNOTATION_INDEX_SIZE:
+      transcriptsAnnotations[key] = IntervalIndex(
+        (tA.chromosomeInterval, tA) for tA in annotations)
+
+
+def _makeTranscript(tokens, transcriptsAnnotations):
+  """ Parse the bed TOKENS into a Transcript, attaching the annotations from
+  TRANSCRIPTSANNOTATIONS (see _addAnnotation()) that it contains.
+  """
+  assert len(tokens) == 12
+  # Transcript
+  name = tokens[3]
+  # Get the chromosome interval
+  assert tokens[5] in ['+', '-']
+  cI = ChromosomeInterval(tokens[0], tokens[1], tokens[2], tokens[5] == '+')
+  # Get the exons
+  def getExons(exonNumber, blockSizes, blockStarts):
+    assert exonNumber == len(blockSizes)
+    assert exonNumber == len(blockStarts)
+    return [ChromosomeInterval(
+        cI.chromosome, cI.start + int(blockStarts[i]),
+        cI.start + int(blockStarts[i]) + int(blockSizes[i]), cI.strand)
+            for i in range(exonNumber)]
+  exons = getExons(int(tokens[9]),
+                   tokens[10].split(','), tokens[11].split(','))
+  # Get the name annotations
+  annotations = transcriptsAnnotations.get((name, cI.chromosome), [])
+  if isinstance(annotations, IntervalIndex):
+    filteredAnnotations = annotations.within(cI)
+  else:
+    filteredAnnotations = [tA for tA in annotations
+                           if cI.contains(tA.chromosomeInterval)]
+  for tA in filteredAnnotations:
+    tA.chromosomeInterval.strand = cI.strand
+  return Transcript(
+    cI, name, exons, filteredAnnotations,
+    int(tokens[4]), int(tokens[6]),
+    int(tokens[7]), tokens[8])
+
+
+def _chromosomeGroups(bedStream, description):
+  """ Group the tokenized lines of the chromosome sorted BEDSTREAM by
+  chromosome, yielding (chromosome, tokens iterator) pairs. DESCRIPTION
+  names the stream in the error raised if it is not sorted.
+  """
+  prev = None
+  for chrom, group in groupby(tokenizeBedStream(bedStream),
+                              key=lambda tokens: tokens[0]):
+    if prev is not None and chrom <= prev:
+      raise RuntimeError('%s is not sorted by chromosome: %s follows %s'
+                         % (description, chrom, prev))
+    prev = chrom
+    yield chrom, group
+
+
+def _mergeTranscriptIterator(transcriptsBedStream, transcriptDetailsBedStream):
+  """ transcriptIterator() for chromosome sorted streams. Advances through
+  both streams together, holding one chromosome of annotations at a time.
+  """
+  details = _chromosomeGroups(transcriptDetailsBedStream, 'details bed')
+  detailsChrom, detailsGroup = next(details, (None, None))
+  for chrom, group in _chromosomeGroups(transcriptsBedStream, 'bed'):
+    # skip annotations on chromosomes that have no transcripts
+    while detailsChrom is not None and detailsChrom < chrom:
+      detailsChrom, detailsGroup = next(details, (None, None))
+    transcriptsAnnotations = {}
+    if detailsChrom == chrom:
+      for tokens in detailsGroup:
+        _addAnnotation(tokens, transcriptsAnnotations)
+      _indexAnnotations(transcriptsAnnotations)
+    for tokens in group:
+      yield _makeTranscript(tokens, transcriptsAnnotations)
 
 
 def writeAllBeds(transcripts, args):
-  """ Convenience function to take a list of TRANSCRIPTS and write out the
-  standard and details beds to the expected location in args.outDir.
+  """ Convenience function to take TRANSCRIPTS, a list or any other iterable
+  of Transcript objects, and write out the standard and details beds to the
+  expected location in args.outDir.
   """
   out_bed, out_bed_details = getBedOutFiles(args)
-  writeTranscriptBedFile(transcripts, out_bed)
-  writeDetailsBedFile(transcripts, out_bed_details)
+  writeSortedBeds(transcripts, out_bed, out_bed_details)
+
+
+SORT_BUFFER_SIZE = 200000  # records held in memory by _ExternalSort
+
+
+class _ExternalSort(object):
+  """ Sorts any number of records (tuples of marshal-able values) holding at
+  most BUFFERSIZE of them in memory. Sorted runs are spilled to temporary
+  files in TMPDIR and merged when the object is iterated over. If UNIQUE,
+  duplicate records are dropped: the records held in memory are a set, and
+  duplicates in different runs are dropped as they are merged.
+  """
+  def __init__(self, tmpDir=None, bufferSize=SORT_BUFFER_SIZE, unique=False):
+    self._tmpDir = tmpDir
+    self._bufferSize = bufferSize
+    self._unique = unique
+    self._buffer = set() if unique else []
+    self._runs = []
+
+  def add(self, record):
+    if self._unique:
+      self._buffer.add(record)
+    else:
+      self._buffer.append(record)
+    if len(self._buffer) >= self._bufferSize:
+      self._spill()
+
+  def _spill(self):
+    records = sorted(self._buffer)
+    f = tempfile.TemporaryFile(dir=self._tmpDir)
+    for i in xrange(0, len(records), 4096):
+      marshal.dump(records[i:i + 4096], f)
+    f.seek(0)
+    self._runs.append(f)
+    self._buffer = set() if self._unique else []
+
+  def __iter__(self):
+    records = sorted(self._buffer)
+    if not self._runs:
+      return iter(records)
+    merged = heapq.merge(records, *[_readRun(f) for f in self._runs])
+    if self._unique:
+      return (record for record, _ in groupby(merged))
+    return merged
+
+  def close(self):
+    for f in self._runs:
+      f.close()
+    self._runs = []
+    self._buffer = set() if self._unique else []
+
+
+def _readRun(f):
+  """ iterate over the records of a run spilled by _ExternalSort.
+  """
+  while True:
+    try:
+      records = marshal.load(f)
+    except EOFError:
+      return
+    for record in records:
+      yield record
+
+
+def writeSortedBeds(transcripts, bedFile, detailsBedFile,
+                    bufferSize=SORT_BUFFER_SIZE):
+  """ Writes out the bed file and the details bed file for TRANSCRIPTS in a
+  single pass over TRANSCRIPTS, which may be any iterable, with a
+  TranscriptBedWriter.
+  """
+  writer = TranscriptBedWriter(bedFile, detailsBedFile, bufferSize)
+  try:
+    for t in transcripts:
+      writer.add(t)
+    writer.close()
+  finally:
+    writer.discard()
+
+
+def teeBeds(transcripts, bedFile, detailsBedFile):
+  """ Iterate over TRANSCRIPTS, writing them as writeSortedBeds() would to
+  BEDFILE and DETAILSBEDFILE as they pass. Each transcript is written as it
+  is when it passes, later changes to it are not. The files are complete
+  once the iteration is.
+  """
+  writer = TranscriptBedWriter(bedFile, detailsBedFile)
+  try:
+    for t in transcripts:
+      writer.add(t)
+      yield t
+    writer.close()
+  finally:
+    writer.discard()
+
+
+class TranscriptBedWriter(object):
+  """ Writes the transcripts given to add() to BEDFILE and their annotations
+  to DETAILSBEDFILE when close() is called, either of which may be None to
+  not write that file. Transcripts are written in the order of
+  Transcript.__cmp__ (ties keep their input order) and annotations in the
+  order of TranscriptAnnotation.__cmp__ (ties in the order of their lines)
+  with duplicate lines removed. Both are sorted with _ExternalSort so at most
+  BUFFERSIZE records of each are held in memory, the rest are spilled to
+  temporary files next to BEDFILE (or DETAILSBEDFILE).
+  """
+  def __init__(self, bedFile, detailsBedFile, bufferSize=SORT_BUFFER_SIZE):
+    self.bedFile = bedFile
+    self.detailsBedFile = detailsBedFile
+    tmpDir = os.path.dirname(os.path.abspath(
+      bedFile if bedFile is not None else detailsBedFile))
+    self._transcriptRecords = _ExternalSort(tmpDir, bufferSize)
+    self._annotationRecords = _ExternalSort(tmpDir, bufferSize, unique=True)
+    self._count = 0
+
+  def add(self, t):
+    """ add the transcript T, as it is now, and its annotations.
+    """
+    if self.bedFile is not None:
+      cI = t.chromosomeInterval
+      self._transcriptRecords.add((cI.chromosome, cI.start, cI.stop,
+                                   cI.strand, t.name, self._count,
+                                   t.bedString()))
+      self._count += 1
+    if self.detailsBedFile is not None:
+      for a in t.annotations:
+        aI = a.chromosomeInterval
+        self._annotationRecords.add((aI.chromosome, aI.start, aI.stop,
+                                     aI.strand, a.name, a.bedString()))
+
+  def close(self):
+    """ merge the sorted records and write the files.
+    """
+    try:
+      if self.bedFile is not None:
+        with open(self.bedFile, 'w') as f:
+          for record in self._transcriptRecords:
+            f.write(record[-1] + '\n')
+      if self.detailsBedFile is not None:
+        with open(self.detailsBedFile, 'w') as f:
+          for record in self._annotationRecords:
+            f.write(record[-1] + '\n')
+    finally:
+      self.discard()
+
+  def discard(self):
+    """ drop the records, and their temporary files, without writing. Does
+    nothing after close().
+    """
+    self._transcriptRecords.close()
+    self._annotationRecords.close()
+
+
+def reattachAnnotations(transcripts):
+  """ Iterate over TRANSCRIPTS, leaving each with the annotations it would
+  have if the transcripts were written with writeAllBeds() and read back
+  with iterTranscripts(): only those with the transcript's name that it
+  contains, on its strand, in sorted order and without duplicate lines.
+  This lets filters be chained in memory, see metaFilter --inProcess.
+  Assumes the transcript names are unique on each chromosome, as they are
+  after uniquify.
+  """
+  for t in transcripts:
+    cI = t.chromosomeInterval
+    records = {}
+    for a in t.annotations:
+      aI = a.chromosomeInterval
+      if a.name == t.name and cI.contains(aI):
+        aI.strand = cI.strand
+        records.setdefault((aI.chromosome, aI.start, aI.stop, aI.strand,
+                            a.name, a.bedString()), a)
+    t.annotations = [records[key] for key in sorted(records)]
+    yield t
 
 
 def getBedOutFiles(args):
@@ -994,27 +2852,22 @@ def getBedOutFiles(args):
 
 def writeDetailsBedFile(transcripts, detailsBedFile):
   """ Writes out a details bed file for a set of transcripts - that is the set
-  of annotations of the transcripts. The bed file must be in chromosome order.
+  of annotations of the transcripts, see TranscriptBedWriter.
   """
-  annotations = list(
-    set(reduce(lambda x, y : x + y,
-               [transcript.annotations for transcript in transcripts])))
-  annotations.sort()
-  annotationsFileHandle = open(detailsBedFile, 'w')
-  for annotation in annotations:
-    annotationsFileHandle.write(annotation.bedString() + '\n')
-  annotationsFileHandle.close()
+  writer = TranscriptBedWriter(None, detailsBedFile)
+  for transcript in transcripts:
+    writer.add(transcript)
+  writer.close()
 
 
 def writeTranscriptBedFile(transcripts, bedFile):
-  """ Writes out an bed file for a set of transcripts.
+  """ Writes out an bed file for a set of transcripts, see
+  TranscriptBedWriter.
   """
-  transcripts = transcripts[:]  # no side effects
-  transcripts.sort()
-  bedFileHandle = open(bedFile, 'w')
+  writer = TranscriptBedWriter(bedFile, None)
   for transcript in transcripts:
-    bedFileHandle.write(transcript.bedString() + '\n')
-  bedFileHandle.close()
+    writer.add(transcript)
+  writer.close()
 
 
 def removeAlignmentNumber(s):
@@ -1,11 +1,15 @@
 """ Test the lib_filter classes and functions
 """
+import argparse
 from glob import glob
 import os
+import random
 import shutil
 import string
 import subprocess
 import sys
+import threading
+import time
 import unittest
 import lib_filter
 import imp
@@ -195,6 +199,53 @@ def simplePsl(strand, qSize, qStart, qEnd, tSize, tStart, tEnd,
              ))
   return lib_filter.PslRow(line)
 
+
+def createMetaFilterInputs(tmpDir):
+  """ Create a small set of metaFilter inputs in TMPDIR, see
+  metaFilterCommand().
+  """
+  createSequenceFile({'test_0_nr': 'ATGATTAAGANNATGATTAAGA\n'}, tmpDir)
+  createSequenceFile({'test_0_r': 'ATGATCCAATGA\n'}, tmpDir,
+                     filename='refSeq.fa')
+  pslLines = [simplePsl('+', 8, 0, 8, 22, 1, 9,
+                        [4, 1, 1], [0, 4, 7], [1, 7, 8],
+                        qName='ensmust0', tName='test_0_nr'),
+              simplePsl('+', 8, 0, 8, 22, 13, 21,
+                        [4, 1, 1], [0, 4, 7], [13, 19, 20],
+                        qName='ensmust0', tName='test_0_nr'),
+              ]
+  createAlignmentFile(pslLines, tmpDir)
+  createBedFile([bedLine(
+      'test_0_r', 1, 11, 'ensmust0', 0, '+', 1, 11,
+      '128,0,0', 2, '4,4', '0,6')], 'ref.bed', tmpDir)
+  createBedFile([bedLine(
+      'test_0_nr', 1, 9, 'ensmust0', 0, '+', 1, 9,
+      '128,0,0', 2, '4,2', '0,6'), bedLine(
+      'test_0_nr', 13, 21, 'ensmust0', 0, '+', 13, 21,
+      '128,0,0', 2, '4,2', '0,6')], 'in.bed', tmpDir)
+  createBedFile([bedLine('test_0_nr', 6, 9, 'noStop/ensmust0'),
+                 bedLine('test_0_nr', 18, 21, 'noStop/ensmust0')],
+                'in_details.bed', tmpDir)
+  createBedFile([], 'empty.bed', tmpDir)
+
+
+def metaFilterCommand(outDir):
+  """ Return the metaFilter command line for the inputs made by
+  createMetaFilterInputs(), relative to the directory they are in.
+  """
+  cmd = [metaFilter.getBin('metaFilter')]
+  for name, value in [('refGenome', 'C57B6J'), ('genome', 'C57B6NJ'),
+                      ('geneCheckBed', 'in.bed'),
+                      ('geneCheckBedDetails', 'in_details.bed'),
+                      ('originalGeneCheckBed', 'ref.bed'),
+                      ('originalGeneCheckBedDetails', 'empty.bed'),
+                      ('alignment', 'aln.psl'), ('sequence', 'seq.fa'),
+                      ('refSequence', 'refSeq.fa'),
+                      ('chromSizes', 'empty.bed'), ('outDir', outDir)]:
+    cmd += ['--%s' % name, value]
+  return cmd
+
+
 def numberOfUniqueTranscripts(transcripts):
   """ Given a list of transcripts, return the number of unique names.
   """
@@ -337,6 +388,145 @@ class sequenceGetterTests(unittest.TestCase):
       self.assertTrue(name in sequences)
     self.addCleanup(removeDir, tmpDir)
 
+  def test_readSequence(self):
+    """ readSequence must join records and optionally uppercase them.
+    """
+    lines = ['>chr1 a description\n', 'acgt\n', 'ACGT\n', '\n', 'nn\n',
+             '>chr2\n', '>chr3\n', 'TTTT\r\n', 'G']
+    seqs = list(lib_filter.readSequence(iter(lines)))
+    self.assertEqual([s.name for s in seqs], ['chr1', 'chr2', 'chr3'])
+    self.assertEqual([s.getSequence() for s in seqs],
+                     ['acgtACGTnn', '', 'TTTTG'])
+    self.assertEqual([s.getLength() for s in seqs], [10, 0, 5])
+    seqs = list(lib_filter.readSequence(iter(lines), upper=True))
+    self.assertEqual(seqs[0].getSequence(), 'ACGTACGTNN')
+
+  def test_getMappedSequences(self):
+    """ getSequences(lazy=True) must slice exactly like in-memory Sequences.
+    """
+    sequences = {'chrA': 'acgtNNACGTACGTAAACCCGGGTTTacgtacgtACGTA',
+                 'chrB': 'GATTACA' * 11,
+                 'chrC': 'T',
+                 }
+    makeTempDirParent()
+    tmpDir = os.path.abspath(makeTempDir('getMappedSequences'))
+    testFile = os.path.join(tmpDir, 'seq.fa')
+    with open(testFile, 'w') as f:
+      for name in sorted(sequences):
+        f.write('>%s some description\n' % name)
+        for i in xrange(0, len(sequences[name]), 10):
+          f.write('%s\n' % sequences[name][i:i + 10])
+    for upper in [False, True]:
+      seqDict = lib_filter.getSequences(testFile, upper=upper)
+      mappedDict = lib_filter.getSequences(testFile, upper=upper, lazy=True)
+      self.assertEqual(sorted(seqDict), sorted(mappedDict))
+      for name in seqDict:
+        seq, mapped = seqDict[name], mappedDict[name]
+        self.assertTrue(isinstance(mapped, lib_filter.MappedSequence))
+        self.assertEqual(seq.getLength(), mapped.getLength())
+        self.assertEqual(seq.getSequence(), mapped.getSequence())
+        for start in xrange(0, seq.getLength()):
+          for stop in xrange(start + 1, seq.getLength() + 2):
+            for strand in ['+', '-']:
+              self.assertEqual(seq.sliceSequence(start, stop, strand),
+                               mapped.sliceSequence(start, stop, strand))
+          self.assertEqual(seq.getNucleotide(start, complementNuc=True),
+                           mapped.getNucleotide(start, complementNuc=True))
+    # the index is written next to the fasta and reused
+    self.assertTrue(os.path.exists(testFile + '.fai'))
+    self.assertEqual(lib_filter.getFastaIndex(testFile),
+                     lib_filter.buildFastaIndex(testFile))
+    # irregular line lengths cannot be indexed, fall back to reading the file
+    irregularFile = createSequenceFile({'chrX': 'ACGT\nAC\nACGT\n'}, tmpDir,
+                                       filename='irregular.fa')
+    self.assertRaises(lib_filter.FastaIndexError,
+                      lib_filter.buildFastaIndex, irregularFile)
+    seqDict = lib_filter.getSequences(irregularFile, lazy=True)
+    self.assertEqual(seqDict['chrX'].getSequence(), 'ACGTACACGT')
+    self.addCleanup(removeDir, tmpDir)
+
+  def test_twoBitSequences(self):
+    """ getSequences must prefer an up to date .2bit cache of the fasta.
+    """
+    sequences = {'chrA': 'acgtNNACGTACGTAAACCCGGGTTTacgtnnnnACGTA',
+                 'chrB': 'GATTACA' * 11,
+                 'chrC': 'nNaC',
+                 'chrD': '',
+                 }
+    makeTempDirParent()
+    tmpDir = os.path.abspath(makeTempDir('twoBitSequences'))
+    testFile = createSequenceFile(
+      dict((name, seq + '\n') for name, seq in sequences.items()), tmpDir)
+    self.assertEqual(lib_filter.findTwoBit(testFile), None)
+    twoBit = lib_filter.fastaToTwoBit(testFile)
+    self.assertEqual(twoBit, os.path.join(tmpDir, 'seq.2bit'))
+    self.assertEqual(lib_filter.findTwoBit(testFile), twoBit)
+    for upper in [False, True]:
+      seqDict = lib_filter.getSequences(testFile, upper=upper)
+      self.assertEqual(sorted(seqDict), sorted(sequences))
+      for name, expected in sequences.items():
+        seq = seqDict[name]
+        self.assertTrue(isinstance(seq, lib_filter.TwoBitSequence))
+        if upper:
+          expected = expected.upper()
+        self.assertEqual(seq.getLength(), len(expected))
+        self.assertEqual(seq.getSequence(), expected)
+        plain = lib_filter.Sequence(name, expected)
+        for start in xrange(0, len(expected)):
+          for stop in xrange(start + 1, len(expected) + 2):
+            for strand in ['+', '-']:
+              self.assertEqual(plain.sliceSequence(start, stop, strand),
+                               seq.sliceSequence(start, stop, strand))
+        positions = range(len(expected))
+        random.Random(0).shuffle(positions)
+        for complementNuc in [False, True]:
+          self.assertEqual(
+            ''.join(plain.getNucleotide(p, complementNuc=complementNuc)
+                    for p in positions),
+            seq.getNucleotides(positions, complementNuc=complementNuc))
+        self.assertEqual('', seq.getNucleotides([]))
+    starts, ends = seqDict['chrA'].getNBlocks()
+    self.assertEqual((starts.tolist(), ends.tolist()), ([4, 30], [6, 34]))
+    # ambiguity codes would be lost, refuse to convert
+    iupacFile = createSequenceFile({'chrX': 'ACGTRYACGT\n'}, tmpDir,
+                                   filename='iupac.fa')
+    self.assertRaises(lib_filter.TwoBitError,
+                      lib_filter.fastaToTwoBit, iupacFile)
+    self.addCleanup(removeDir, tmpDir)
+
+  def test_nRunIndex(self):
+    """ NRunIndex should agree with slicing the sequence, for every kind of
+    Sequence.
+    """
+    sequences = {'chrA': 'NNacgtNNACGTACGTAAACCCGGGTTTacgtnnnnACGTAn',
+                 'chrB': 'GATTACA' * 11,
+                 }
+    makeTempDirParent()
+    tmpDir = os.path.abspath(makeTempDir('nRunIndex'))
+    testFile = createSequenceFile(
+      dict((name, seq + '\n') for name, seq in sequences.items()), tmpDir)
+    seqDicts = [lib_filter.getSequences(testFile, upper=True),
+                lib_filter.getSequences(testFile, upper=True, lazy=True)]
+    lib_filter.fastaToTwoBit(testFile)
+    seqDicts.append(lib_filter.getSequences(testFile, upper=True))
+    for seqDict in seqDicts:
+      index = lib_filter.NRunIndex(seqDict)
+      starts, ends = index.getNBlocks('chrA')
+      self.assertEqual((starts.tolist(), ends.tolist()),
+                       ([0, 6, 32, 41], [2, 8, 36, 42]))
+      for name, seq in seqDict.items():
+        for start in xrange(0, seq.getLength()):
+          for stop in xrange(start + 1, seq.getLength() + 1):
+            interval = lib_filter.ChromosomeInterval(name, start, stop, True)
+            s = seq.sliceSequence(start, stop)
+            self.assertEqual(index.containsN(interval), 'N' in s)
+            self.assertEqual(index.countNs(interval), s.count('N'))
+      # an empty interval inside an N run has no Ns
+      empty = lib_filter.ChromosomeInterval('chrA', 33, 33, True)
+      self.assertFalse(index.containsN(empty))
+      self.assertEqual(index.countNs(empty), 0)
+    self.addCleanup(removeDir, tmpDir)
+
 
 class alignmentGetterTests(unittest.TestCase):
   def test_getAlignment(self):
@@ -364,6 +554,66 @@ class alignmentGetterTests(unittest.TestCase):
           data[j], ','.join(map(str, getattr(libAlignments[i], field))) + ',')
     self.addCleanup(removeDir, tmpDir)
 
+  def test_alignmentIndex(self):
+    """ AlignmentIndex must give rows that behave as the PslRows of
+    getAlignments, by any of its lookups, whether parsed or loaded.
+    """
+    alignments = [
+      '141 0 0 0 0 0 0 0 - ENSMUST00000178550.1 141 0 141 scaffold-11326 33702 21065 21206 1 141, 0, 21065,',
+      '309 0 0 0 0 0 0 0 - ENSMUST00000179623.1 309 0 309 scaffold-1475 11716 9284 9593 1 309, 0, 9284,',
+      '700 0 0 0 3 5 2 4 - ENSMUST00000179112.1 705 0 705 scaffold-189833 540197 335509 336213 4 14,129,140,417, 0,15,146,288, 335509,335523,335654,335796,',
+      '20 0 0 0 0 0 0 0 + ENSMUST00000178550.1 141 0 20 scaffold-11326 33702 100 125 2 10,10 0,10 100,115',
+      '141 0 0 0 0 0 0 0 ++ ENSMUST00000178550.1 141 0 141 scaffold-1 33702 21065 21206 1 141, 0, 21065,',
+                  ]
+    makeTempDirParent()
+    tmpDir = os.path.abspath(makeTempDir('alignmentIndex'))
+    testFile = createAlignmentFile(alignments, tmpDir)
+    expected = lib_filter.getAlignments(testFile)
+    index = lib_filter.AlignmentIndex.fromPsl(testFile)
+    # not saved yet
+    self.assertEqual(len(lib_filter.getAlignmentIndex(testFile)), 5)
+    saved = lib_filter.pslToIndex(testFile)
+    self.assertEqual(saved, lib_filter.getAlignmentIndexPath(testFile))
+    loaded = lib_filter.getAlignmentIndex(testFile)
+    for index in [index, loaded]:
+      self.assertEqual(len(index), len(expected))
+      self.assertEqual([a.pslString() for a in index.rows()],
+                       [a.pslString() for a in expected])
+      for a, b in zip(index.rows(), expected):
+        self.assertTrue(isinstance(a, lib_filter.PslTableRow))
+        for field in lib_filter.PslTable.intColumns + (
+            'strand', 'qName', 'tName', 'blockSizes', 'qStarts', 'tStarts'):
+          self.assertEqual(getattr(a, field), getattr(b, field))
+          self.assertEqual(type(getattr(a, field)), type(getattr(b, field)))
+        self.assertEqual(a.hashkey(), b.hashkey())
+      # the coordinates of the last, '++', row do not map
+      for a, b in zip(index.rows()[:4], expected):
+        self.assertEqual(
+          [a.queryCoordinateToTarget(p) for p in xrange(-1, a.qSize + 1)],
+          [b.queryCoordinateToTarget(p) for p in xrange(-1, b.qSize + 1)])
+        self.assertEqual(a.targetCoordinatesToQuery(
+            xrange(a.tStart, a.tEnd)).tolist(),
+                         [b.targetCoordinateToQuery(p) if
+                          b.targetCoordinateToQuery(p) is not None else -1
+                          for p in xrange(b.tStart, b.tEnd)])
+      self.assertEqual(index.column('tStart').tolist(),
+                       [a.tStart for a in expected])
+      for lookup, key in [(index.byQueryTarget(),
+                           lambda a: (a.qName, a.tName)),
+                          (index.byName(),
+                           lambda a: '%s_%s' % (a.qName, a.tName)),
+                          (index.byHashkey(), lambda a: a.hashkey())]:
+        groups = {}
+        for a in expected:
+          groups.setdefault(key(a), []).append(a.pslString())
+        self.assertEqual(sorted(lookup.keys()), sorted(groups))
+        for k, pslStrings in groups.items():
+          self.assertTrue(k in lookup)
+          self.assertEqual([a.pslString() for a in lookup[k]], pslStrings)
+        self.assertEqual(lookup.get('nothing', []), [])
+      self.assertEqual(len(index.byQueryTarget()), 4)
+    self.addCleanup(removeDir, tmpDir)
+
 
 class transcriptIteratorTests(unittest.TestCase):
   def test_transcriptIterator(self):
@@ -750,6 +1000,384 @@ class transcriptIteratorTests(unittest.TestCase):
     # cleanup
     self.addCleanup(removeDir, tmpDir)
 
+  def test_transcriptIterator_sortedStreams(self):
+    """ the chromosome merge mode should read the same transcripts as the
+    default mode from sorted streams and refuse unsorted ones.
+    """
+    transcriptBedLines = []
+    transcriptBedLines.append(bedLine(
+        '1', 2812346, 3113783, 'ENSMUST00000095795.4', 0, '+', 2812370, 3038729,
+        '128,0,0', 9, '54,2,89,249,197,52,105,13,85',
+        '0,58,62,698,1209,1418,226292,301050,301352'))
+    transcriptBedLines.append(bedLine(
+        'scaffold-100021', 466, 4248, 'ENSMUST00000034053.5', 0, '-', 466, 4248,
+        '128,0,0', 2, '85,152', '0,3630'))
+    transcriptBedLines.append(bedLine(
+        'scaffold-2051', 13759, 24866, 'ENSMUST00000034053.5', 0, '-', 14291,
+        24866, '128,0,0', 4, '722,112,131,188', '0,1977,4316,10919'))
+    transcriptDetailsBedLines = []
+    transcriptDetailsBedLines.append(bedLine(
+        '0', 10, 13, 'noStop/ENSMUST00000095795.4'))
+    transcriptDetailsBedLines.append(bedLine(
+        '1', 2812346, 2812349, 'noStop/ENSMUST00000095795.4'))
+    transcriptDetailsBedLines.append(bedLine(
+        '1', 3113780, 3113783, 'noStart/ENSMUST00000095795.4'))
+    transcriptDetailsBedLines.append(bedLine(
+        'scaffold-100021', 466, 469, 'noStop/ENSMUST00000034053.5'))
+    transcriptDetailsBedLines.append(bedLine(
+        'scaffold-138877', 4903, 4906, 'noStop/ENSMUST00000034053.5'))
+    transcriptDetailsBedLines.append(bedLine(
+        'scaffold-2051', 24863, 24866, 'noStart/ENSMUST00000034053.5'))
+    transcriptDetailsBedLines.append(bedLine(
+        'scaffold-3', 1, 4, 'noStart/ENSMUST00000034053.5'))
+    expected = list(lib_filter.transcriptIterator(
+        transcriptBedLines, transcriptDetailsBedLines))
+    merged = list(lib_filter.transcriptIterator(
+        iter(transcriptBedLines), iter(transcriptDetailsBedLines),
+        sortedStreams=True))
+    self.assertEqual(len(merged), 3)
+    self.assertEqual([t.bedString() for t in merged],
+                     [t.bedString() for t in expected])
+    self.assertEqual([t.annotations for t in merged],
+                     [t.annotations for t in expected])
+    self.assertEqual([len(t.annotations) for t in merged], [2, 1, 1])
+    # no details at all
+    merged = list(lib_filter.transcriptIterator(
+        transcriptBedLines, [], sortedStreams=True))
+    self.assertEqual([t.annotations for t in merged], [[], [], []])
+    # out of order streams
+    self.assertRaises(RuntimeError, list, lib_filter.transcriptIterator(
+        transcriptBedLines[::-1], transcriptDetailsBedLines,
+        sortedStreams=True))
+    self.assertRaises(RuntimeError, list, lib_filter.transcriptIterator(
+        transcriptBedLines,
+        transcriptDetailsBedLines[3:4] + transcriptDetailsBedLines[:3] +
+        transcriptDetailsBedLines[4:],
+        sortedStreams=True))
+    # named pipes are read in the same single pass
+    makeTempDirParent()
+    tmpDir = os.path.abspath(makeTempDir('sortedStreams'))
+    self.addCleanup(removeDir, tmpDir)
+    writers = []
+    fifos = []
+    for name, lines in [('test.fifo', transcriptBedLines),
+                        ('test_details.fifo', transcriptDetailsBedLines)]:
+      fifo = os.path.join(tmpDir, name)
+      os.mkfifo(fifo)
+      self.assertEqual(lib_filter.FileType(fifo), fifo)
+
+      def write(fifo=fifo, lines=lines):
+        with open(fifo, 'w') as f:
+          f.write(''.join(l + '\n' for l in lines))
+      writers.append(threading.Thread(target=write))
+      writers[-1].start()
+      fifos.append(fifo)
+    merged = list(lib_filter.iterTranscripts(fifos[0], fifos[1],
+                                             sortedStreams=True))
+    for writer in writers:
+      writer.join()
+    self.assertEqual([t.bedString() for t in merged],
+                     [t.bedString() for t in expected])
+    self.assertEqual([t.annotations for t in merged],
+                     [t.annotations for t in expected])
+
+  def test_writeSortedBeds(self):
+    """ writeSortedBeds should write the same beds as writeTranscriptBedFile and
+    writeDetailsBedFile from a generator, whether or not it spills to disk.
+    """
+    rand = random.Random(7)
+    transcriptBedLines = []
+    transcriptDetailsBedLines = []
+    for i in xrange(60):
+      chrom = 'scaffold-%d' % rand.randint(0, 4)
+      start = rand.randint(0, 1000)
+      name = 'ENSMUST%02d.1' % rand.randint(0, 20)
+      transcriptBedLines.append(bedLine(
+          chrom, start, start + 100, name, 0, rand.choice('+-'), start,
+          start + 100, '128,0,0', 2, '40,30', '0,70'))
+      for j in xrange(rand.randint(0, 3)):
+        s = rand.randint(start, start + 97)
+        transcriptDetailsBedLines.append(bedLine(
+            chrom, s, s + 3, '%s/%s' % (rand.choice(['noStart', 'noStop']),
+                                        name)))
+    transcripts = list(lib_filter.transcriptIterator(
+        transcriptBedLines, transcriptDetailsBedLines))
+    makeTempDirParent()
+    tmpDir = os.path.abspath(makeTempDir('writeSortedBeds'))
+    expectedBed = os.path.join(tmpDir, 'expected.bed')
+    expectedDetailsBed = os.path.join(tmpDir, 'expected_details.bed')
+    lib_filter.writeTranscriptBedFile(transcripts, expectedBed)
+    lib_filter.writeDetailsBedFile(transcripts, expectedDetailsBed)
+    with open(expectedBed) as f:
+      expectedBedLines = f.read().splitlines()
+    with open(expectedDetailsBed) as f:
+      expectedDetailsLines = f.read().splitlines()
+    self.assertEqual(len(expectedDetailsLines), len(set(expectedDetailsLines)))
+    for bufferSize in [1, 7, 1000]:
+      bed = os.path.join(tmpDir, 'out.bed')
+      detailsBed = os.path.join(tmpDir, 'out_details.bed')
+      lib_filter.writeSortedBeds((t for t in transcripts), bed, detailsBed,
+                                 bufferSize=bufferSize)
+      with open(bed) as f:
+        self.assertEqual(f.read().splitlines(), expectedBedLines)
+      with open(detailsBed) as f:
+        self.assertEqual(f.read().splitlines(), expectedDetailsLines)
+      # reading back, a chromosome at a time, gives the same transcripts
+      self.assertEqual(
+        [t.bedString() for t in lib_filter.iterTranscripts(
+            bed, detailsBed, sortedStreams=True)],
+        expectedBedLines)
+    # duplicate annotation lines are dropped across spilled runs too
+    for bufferSize in [1, 1000]:
+      writer = lib_filter.TranscriptBedWriter(bed, detailsBed, bufferSize)
+      for t in transcripts + transcripts[::-1]:
+        writer.add(t)
+      writer.close()
+      with open(bed) as f:
+        self.assertEqual(f.read().splitlines(),
+                         [l for l in expectedBedLines for i in xrange(2)])
+      with open(detailsBed) as f:
+        self.assertEqual(f.read().splitlines(), expectedDetailsLines)
+    # spill files are cleaned up
+    self.assertEqual(sorted(os.listdir(tmpDir)),
+                     ['expected.bed', 'expected_details.bed',
+                      'out.bed', 'out_details.bed'])
+    unsortedBed = createBedFile(
+      [transcriptBedLines[0], bedLine('aaa', 0, 3, 'a'),
+       transcriptBedLines[0]], 'unsorted.bed', tmpDir)
+    self.assertRaises(RuntimeError, list, lib_filter.iterTranscripts(
+        unsortedBed, detailsBed, sortedStreams=True))
+    self.addCleanup(removeDir, tmpDir)
+
+
+class memoStoreTests(unittest.TestCase):
+  def test_memoized(self):
+    """ memoized should restore the transcript and result that the compute
+    function produced, until the transcript or a key part changes.
+    """
+    makeTempDirParent()
+    tmpDir = os.path.abspath(makeTempDir('memoized'))
+    self.addCleanup(removeDir, tmpDir)
+    connection = lib_filter.MemoStore.connect(os.path.join(tmpDir, 'memo.db'))
+    memo = lib_filter.MemoStore(connection, metaFilter.getBin('nonsense'))
+    bedLines = [bedLine('scaffold-1', 10, 100, 'ENSMUST01.1', 0, '-', 10, 100,
+                        '128,0,0', 2, '40,30', '0,60')]
+    detailsLines = [bedLine('scaffold-1', 20, 23, 'noStart/ENSMUST01.1')]
+
+    def read():
+      return list(lib_filter.transcriptIterator(bedLines, detailsLines))[0]
+
+    def compute(t):
+      t.exons[0].stop = t.exons[1].stop
+      t.exons.pop()
+      t.invalidateCache()
+      annot = lib_filter.TranscriptAnnotation(
+        lib_filter.ChromosomeInterval('scaffold-1', 30, 33, False), t.name,
+        ['nonsense'])
+      t.annotations.append(annot)
+      return {'count': len(t.exons), 'lengths': [1.5]}
+
+    def fail(t):
+      self.fail('memoized should not compute a stored result')
+    expected, result = lib_filter.memoized(memo, read(), compute,
+                                           lambda t: ['ACGT'])
+    self.assertEqual(result, {'count': 1, 'lengths': [1.5]})
+    self.assertEqual(memo.misses, 1)
+    memo.commit()
+    # a new connection sees the stored result
+    memo = lib_filter.MemoStore(
+      lib_filter.MemoStore.connect(os.path.join(tmpDir, 'memo.db')),
+      metaFilter.getBin('nonsense'))
+    t, result = lib_filter.memoized(memo, read(), fail, lambda t: ['ACGT'])
+    self.assertEqual(memo.hits, 1)
+    self.assertEqual(t, expected)
+    self.assertEqual(t.bedString(), expected.bedString())
+    self.assertEqual(result, {'count': 1, 'lengths': [1.5]})
+    self.assertEqual(t.getMRnaLength(), 90)
+    # other key parts, annotations or filters are computed
+    self.assertEqual(
+      lib_filter.memoized(memo, read(), compute, lambda t: ['ACGA'])[0],
+      expected)
+    detailsLines = []
+    lib_filter.memoized(memo, read(), compute, lambda t: ['ACGT'])
+    self.assertEqual(memo.misses, 2)
+    other = lib_filter.MemoStore(memo.connection, metaFilter.getBin('indel'))
+    lib_filter.memoized(other, read(), compute, lambda t: ['ACGT'])
+    self.assertEqual(other.misses, 1)
+    self.assertEqual(lib_filter.memoized(None, read(), compute, None)[1],
+                     {'count': 1, 'lengths': [1.5]})
+    # memoizedBatch computes only the transcripts that are not stored
+    computed = []
+
+    def computeAll(transcripts):
+      computed.extend(transcripts)
+      return [compute(t) for t in transcripts]
+    first = lib_filter.memoizedBatch(memo, [read()], computeAll,
+                                     lambda t: ['batch'])
+    pairs = lib_filter.memoizedBatch(memo, [read(), read()], computeAll,
+                                     lambda t: ['batch'])
+    self.assertEqual(len(computed), 1)
+    self.assertEqual(pairs, first * 2)
+    self.assertEqual(
+      lib_filter.memoizedBatch(None, [read()], computeAll, None), first)
+
+  def test_memoStore_shared(self):
+    """ MemoStores of several processes on one database must not hold its
+    write lock between their commits.
+    """
+    makeTempDirParent()
+    tmpDir = os.path.abspath(makeTempDir('memoStore_shared'))
+    self.addCleanup(removeDir, tmpDir)
+    path = os.path.join(tmpDir, 'memo.db')
+    a, b = [lib_filter.MemoStore(lib_filter.MemoStore.connect(path, timeout=1),
+                                 metaFilter.getBin('nonsense'))
+            for i in xrange(2)]
+    a.put('x', [1])
+    self.assertEqual(a.get('x'), [1])
+    # this would time out if A's put had taken the write lock
+    b.put('y', [2])
+    b.commit()
+    a.commit()
+    for memo in [a, b]:
+      self.assertEqual((memo.get('x'), memo.get('y')), ([1], [2]))
+    self.assertEqual(
+      a.connection.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+
+
+class mapTranscriptsTests(unittest.TestCase):
+  def test_mapTranscripts(self):
+    """ mapTranscripts should give the same transcripts and results, in the
+    same order, with any number of workers.
+    """
+    rand = random.Random(3)
+    transcriptBedLines = []
+    transcriptDetailsBedLines = []
+    for chrom in ['scaffold-%d' % i for i in xrange(5)]:
+      for i in xrange(rand.randint(0, 30)):
+        start = rand.randint(0, 1000)
+        name = 'ENSMUST%02d.1' % rand.randint(0, 20)
+        transcriptBedLines.append(bedLine(
+            chrom, start, start + 100, name, 0, rand.choice('+-'), start,
+            start + 100, '128,0,0', 2, '40,30', '0,70'))
+        transcriptDetailsBedLines.append(bedLine(
+            chrom, start, start + 3, 'noStart/%s' % name))
+
+    def function(t):
+      annot = lib_filter.TranscriptAnnotation(
+        lib_filter.ChromosomeInterval(t.chromosomeInterval.chromosome,
+                                      t.exons[1].start, t.exons[1].start + 3,
+                                      t.chromosomeInterval.strand),
+        t.name, ['mapped'])
+      t.annotations.append(annot)
+      t.exons.pop()
+      return [t.getExonLength(), len(t.annotations)]
+
+    def run(workers):
+      transcripts = lib_filter.transcriptIterator(
+        transcriptBedLines, transcriptDetailsBedLines)
+      return [(t.bedString(), [a.bedString() for a in t.annotations], result)
+              for t, result in lib_filter.mapTranscripts(
+                  transcripts, function, workers)]
+    expected = run(1)
+    self.assertEqual(len(expected), len(transcriptBedLines))
+    chunkSize = lib_filter.PARALLEL_CHUNK_SIZE
+    try:
+      lib_filter.PARALLEL_CHUNK_SIZE = 4
+      for workers in [2, 3]:
+        self.assertEqual(run(workers), expected)
+    finally:
+      lib_filter.PARALLEL_CHUNK_SIZE = chunkSize
+
+
+class chromosomeIntervalTests(unittest.TestCase):
+  def test_hashing(self):
+    """ equal ChromosomeIntervals and TranscriptAnnotations must hash equally.
+    """
+    a = lib_filter.ChromosomeInterval('c', 10, 20, True)
+    b = lib_filter.ChromosomeInterval('c', 10, 20, True)
+    self.assertEqual(1, len(set([a, b])))
+    self.assertEqual(
+      3, len(set([a, lib_filter.ChromosomeInterval('c', 10, 20, False),
+                  lib_filter.ChromosomeInterval('d', 10, 20, True)])))
+    annots = []
+    for interval in [a, b, a]:
+      annot = lib_filter.TranscriptAnnotation(interval, 'n', ['insertion'])
+      annots.append(annot)
+    annots[2].addLabel('deletion')
+    self.assertEqual(annots[0], annots[1])
+    self.assertEqual(2, len(set(annots)))
+
+  def test_intervalSet(self):
+    """ IntervalSet lookups must agree with a linear scan.
+    """
+    rand = random.Random(0)
+    intervals = []
+    for i in xrange(300):
+      start = rand.randint(0, 1000)
+      intervals.append(lib_filter.ChromosomeInterval(
+        rand.choice('ab'), start, start + rand.randint(0, 50),
+        rand.choice([True, False])))
+    intervalSet = lib_filter.IntervalSet(intervals)
+    self.assertEqual(len(set(intervals)), len(intervalSet))
+    for i in xrange(300):
+      start = rand.randint(-60, 1060)
+      query = lib_filter.ChromosomeInterval(
+        rand.choice('abc'), start, start + rand.randint(0, 30),
+        rand.choice([True, False]))
+      self.assertEqual(query in intervals, query in intervalSet)
+
+  def test_intervalIndex(self):
+    """ IntervalIndex queries must agree with a linear scan.
+    """
+    rand = random.Random(1)
+    intervals = []
+    index = lib_filter.IntervalIndex()
+    for i in xrange(400):
+      start = rand.randint(0, 2000)
+      interval = lib_filter.ChromosomeInterval(
+        rand.choice('ab'), start, start + rand.choice([0, 1, 5, 20, 300]),
+        None)
+      intervals.append(interval)
+      index.add(interval, i)
+    self.assertEqual(len(intervals), len(index))
+    for i in xrange(400):
+      start = rand.randint(-100, 2400)
+      query = lib_filter.ChromosomeInterval(
+        rand.choice('abc'), start, start + rand.choice([0, 1, 3, 50, 400]),
+        None)
+      self.assertEqual([i for i, x in enumerate(intervals)
+                        if x.chromosome == query.chromosome and
+                        query.contains(x)],
+                       index.within(query))
+
+  def test_transcriptIterator_indexedAnnotations(self):
+    """ Annotations of transcripts with many copies, which are attached with
+    an IntervalIndex, must be the same as those attached by a scan.
+    """
+    rand = random.Random(2)
+    transcriptBedLines = []
+    transcriptDetailsBedLines = []
+    for i in xrange(80):
+      start = rand.randint(0, 5000)
+      transcriptBedLines.append(bedLine(
+          'c', start, start + 100, 'ENSMUST01.1', 0, rand.choice('+-'), start,
+          start + 100, '128,0,0', 2, '40,30', '0,70'))
+      for j in xrange(3):
+        s = rand.randint(start - 5, start + 100)
+        transcriptDetailsBedLines.append(bedLine(
+            'c', s, s + 3, '%s/ENSMUST01.1' % rand.choice(['a', 'b'])))
+
+    def annotations(indexSize):
+      old = lib_filter.ANNOTATION_INDEX_SIZE
+      lib_filter.ANNOTATION_INDEX_SIZE = indexSize
+      try:
+        return [[a.bedString() for a in t.annotations]
+                for t in lib_filter.transcriptIterator(
+                  transcriptBedLines, transcriptDetailsBedLines)]
+      finally:
+        lib_filter.ANNOTATION_INDEX_SIZE = old
+    self.assertEqual(annotations(10 ** 9), annotations(0))
+
 
 class pslCoordinateSpaceTests(unittest.TestCase):
   def test_psl_targetCoordinateToQuery(self):
@@ -1052,6 +1680,76 @@ class pslCoordinateSpaceTests(unittest.TestCase):
       self.assertEqual(t, psl.queryCoordinateToTarget(psl.targetCoordinateToQuery(t)))
       self.assertEqual(q, psl.targetCoordinateToQuery(psl.queryCoordinateToTarget(q)))
 
+  def test_psl_bulkCoordinates(self):
+    """ The vectorized PslRow mappers should agree with the scalar ones.
+    """
+    psls = []
+    psls.append(simplePsl('+', 10, 0, 10, 10, 0, 10, [10], [0], [0]))
+    psls.append(simplePsl('+', 10, 3, 8, 10, 1, 6, [5], [3], [1]))
+    psls.append(simplePsl('+', 20, 3, 17, 30, 1, 22,
+                          [5, 3, 2], [3, 8, 15], [1, 10, 20]))
+    psls.append(simplePsl('-', 24, 3, 17, 30, 1, 22,
+                          [5, 3, 2], [3, 8, 15], [1, 10, 20]))
+    psls.append(simplePsl('-', 5353, 101, 3546, 31353, 11338, 31141,
+                          [168,136,213,816,100,571],
+                          [1807,2922,3058,3271,4581,4681],
+                          [11338,13222,13580,13796,29960,30570],))
+    psls.append(simplePsl('-', 61, 4, 56, 61, 0, 61, [20, 18], [5, 39], [0, 20]))
+    for psl in psls:
+      targets = range(-2, psl.tSize + 2)
+      queries = range(-2, psl.qSize + 2)
+      expected = [psl.targetCoordinateToQuery(p) for p in targets]
+      self.assertEqual(
+        [None if q == -1 else q
+         for q in psl.targetCoordinatesToQuery(targets).tolist()], expected)
+      expected = [psl.queryCoordinateToTarget(p) for p in queries]
+      self.assertEqual(
+        [None if t == -1 else t
+         for t in psl.queryCoordinatesToTarget(xrange(-2, psl.qSize + 2))
+         .tolist()], expected)
+
+  def test_psl_coordinateMaps(self):
+    """ PslRow.targetToQueryMap() and queryToTargetMap() cover their ranges.
+    """
+    psl = simplePsl('-', 24, 3, 17, 30, 1, 22,
+                    [5, 3, 2], [3, 8, 15], [1, 10, 20])
+    self.assertEqual(
+      psl.targetToQueryMap().tolist(),
+      [-1 if q is None else q for q in
+       [psl.targetCoordinateToQuery(p) for p in xrange(1, 22)]])
+    self.assertEqual(
+      psl.queryToTargetMap().tolist(),
+      [-1 if t is None else t for t in
+       [psl.queryCoordinateToTarget(p) for p in xrange(0, 24)]])
+
+  def test_psl_blocks(self):
+    """ PslRow.targetBlocks() and queryBlocks() should cover exactly the
+    positions that the scalar mappers map, in runs.
+    """
+    def expand(runs, step):
+      return [(p, other + step * (p - start))
+              for start, stop, other in runs for p in xrange(start, stop)]
+    psls = []
+    psls.append(simplePsl('+', 20, 3, 17, 30, 1, 22,
+                          [5, 3, 2], [3, 8, 15], [1, 10, 20]))
+    psls.append(simplePsl('-', 24, 3, 17, 30, 1, 22,
+                          [5, 3, 2], [3, 8, 15], [1, 10, 20]))
+    psls.append(simplePsl('-', 61, 4, 56, 61, 0, 61, [20, 18], [5, 39], [0, 20]))
+    for psl in psls:
+      step = 1 if psl.strand == '+' else -1
+      for start, stop in [(0, psl.tSize), (4, 12), (12, 4)]:
+        self.assertEqual(
+          expand(psl.targetBlocks(start, stop), step),
+          [(p, psl.targetCoordinateToQuery(p)) for p in xrange(start, stop)
+           if psl.targetCoordinateToQuery(p) is not None])
+      for start, stop in [(0, psl.qSize), (4, 12), (12, 4)]:
+        self.assertEqual(
+          expand(psl.queryBlocks(start, stop), step),
+          [(p, psl.queryCoordinateToTarget(p)) for p in xrange(start, stop)
+           if psl.queryCoordinateToTarget(p) is not None])
+    self.assertEqual(psls[1].queryBlocks(0, 24),
+                     [(7, 9, 21), (13, 16, 12), (16, 21, 5)])
+
 
 class codonGeneSpaceTests(unittest.TestCase):
   def test_transcript_getMRna_0(self):
@@ -1146,6 +1844,41 @@ class codonGeneSpaceTests(unittest.TestCase):
     self.assertEqual(len(truth), len(mrna))
     self.assertEqual(truth, mrna)
 
+  def test_transcript_getMRnas(self):
+    """ getMRnas() should return the same mRNAs as Transcript.getMRna().
+    """
+    rand = random.Random(0)
+    seq = lib_filter.Sequence(
+      'c', ''.join(rand.choice('ACGTNacgtn') for i in xrange(2000)))
+    transcripts = []
+    for n in xrange(100):
+      exons = []
+      pos = rand.randint(0, 1000)
+      for i in xrange(rand.randint(1, 6)):
+        start = pos + rand.randint(1 if i else 0, 30)
+        pos = start + rand.randint(1, 80)
+        exons.append((start, pos))
+      thickStart = rand.randint(exons[0][0] - 3, pos)
+      thickEnd = rand.randint(thickStart + 1, pos + 3)
+      strand = rand.random() < 0.5
+      transcripts.append(lib_filter.Transcript(
+        lib_filter.ChromosomeInterval('c', exons[0][0], pos, strand), 't',
+        [lib_filter.ChromosomeInterval('c', a, b, strand) for a, b in exons],
+        [], 0, thickStart, thickEnd, '0'))
+    for subset in [transcripts, transcripts[:1], [],
+                   [t for t in transcripts if t.chromosomeInterval.strand],
+                   [t for t in transcripts if not t.chromosomeInterval.strand]]:
+      mRnas, offsets = lib_filter.getMRnas(subset, seq)
+      self.assertEqual(len(subset) + 1, len(offsets))
+      self.assertEqual(len(mRnas), offsets[-1])
+      for i, t in enumerate(subset):
+        self.assertEqual(t.getMRna(seq), mRnas[offsets[i]:offsets[i + 1]])
+    for t in transcripts:
+      self.assertEqual(
+        ''.join(seq.getSequence()[a:b] for a, b in t.getMRnaSlices()),
+        lib_filter.reverseComplement(t.getMRna(seq))
+        if not t.chromosomeInterval.strand else t.getMRna(seq))
+
   def test_transcript_mRnaCoordinateToExon(self):
     """ mRnaCoordinateToExon() must return correct values.
     """
@@ -1832,6 +2565,77 @@ class codonGeneSpaceTests(unittest.TestCase):
     for i in xrange(8, 10):
       self.assertEqual(8 + 1 - i, t.chromosomeCoordinateToMRna(i))
 
+  def test_transcript_exonCache(self):
+    """ Transcript coordinate transforms must follow changes to the exons.
+    """
+    t = lib_filter.Transcript(
+      lib_filter.ChromosomeInterval('c', 0, 20, True), 't0',
+      [lib_filter.ChromosomeInterval('c', 0, 5, True),
+       lib_filter.ChromosomeInterval('c', 10, 20, True)],
+      [], 0, 2, 18, '0')
+    self.assertEqual(t.getExonLength(), 15)
+    self.assertEqual(t.getMRnaLength(), 11)
+    self.assertEqual(t.mRnaCoordinateToChromosome(3), 10)
+    self.assertEqual(t.chromosomeCoordinateToMRna(10), 3)
+    # in place modification requires invalidateCache()
+    t.exons[0].stop = 8
+    t.invalidateCache()
+    self.assertEqual(t.getExonLength(), 18)
+    self.assertEqual(t.mRnaCoordinateToChromosome(3), 5)
+    self.assertEqual(t.chromosomeCoordinateToMRna(10), 6)
+    # replacing the exons or thick bounds is noticed automatically
+    t.exons = t.exons[1:]
+    self.assertEqual(t.getExonLength(), 10)
+    self.assertEqual(t.exonCoordinateToChromosome(0), 10)
+    t.thickStart = 12
+    self.assertEqual(t.mRnaCoordinateToChromosome(0), 12)
+    self.assertEqual(t.getMRnaLength(), 6)
+    t.chromosomeInterval.strand = False
+    self.assertEqual(t.exonCoordinateToChromosome(0), 19)
+    # even by a list of the same length, which may reuse the freed list's id
+    t.exons = [lib_filter.ChromosomeInterval('c', 11, 20, True)]
+    self.assertEqual(t.getExonLength(), 9)
+    self.assertEqual(t.exonCoordinateToChromosome(0), 19)
+    self.assertEqual(t.exonCoordinateToChromosome(8), 11)
+
+  def test_transcript_coordinateArrays(self):
+    """ The vectorized Transcript transforms must agree with the scalar ones.
+    """
+    rand = random.Random(0)
+    for n in xrange(200):
+      exons = []
+      pos = rand.randint(0, 5)
+      for i in xrange(rand.randint(1, 6)):
+        start = pos + rand.randint(1 if i else 0, 5)
+        pos = start + rand.randint(1, 8)
+        exons.append((start, pos))
+      thickStart = rand.randint(exons[0][0], pos - 1)
+      thickEnd = rand.randint(thickStart, pos)
+      strand = rand.random() < 0.5
+      t = lib_filter.Transcript(
+        lib_filter.ChromosomeInterval('c', exons[0][0], pos, strand), 't',
+        [lib_filter.ChromosomeInterval('c', a, b, strand) for a, b in exons],
+        [], 0, thickStart, thickEnd, '0')
+      positions = range(-2, pos + 3)
+      for scalar, vector in [
+          (t.exonCoordinateToChromosome, t.exonCoordinatesToChromosome),
+          (t.chromosomeCoordinateToExon, t.chromosomeCoordinatesToExon),
+          (t.exonCoordinateToMRna, t.exonCoordinatesToMRna),
+          (t.mRnaCoordinateToChromosome, t.mRnaCoordinatesToChromosome),
+          (t.chromosomeCoordinateToMRna, t.chromosomeCoordinatesToMRna)]:
+        expected = [scalar(p) for p in positions]
+        expected = [-1 if v is None else v for v in expected]
+        self.assertEqual(vector(positions).tolist(), expected)
+      self.assertEqual(
+        t.exonToChromosomeMap().tolist(),
+        [t.exonCoordinateToChromosome(p) for p in xrange(t.getExonLength())])
+      self.assertEqual(
+        t.mRnaToChromosomeMap().tolist(),
+        [-1 if v is None else v for v in
+         [t.mRnaCoordinateToChromosome(p)
+          for p in xrange(t.getMRnaLength())]])
+
+
 class codonAminoAcidTests(unittest.TestCase):
   def test_codonToAminoAcid(self):
     """ codonToAminoAcid() needs to return correct amino acids for all codons.
@@ -1875,6 +2679,32 @@ class codonAminoAcidTests(unittest.TestCase):
           self.assertEqual(aa, lib_filter.codonToAminoAcid(
               c[0].lower() + c[1] + c[2].lower()))
 
+  def test_translateCodons(self):
+    """ translateCodons() and friends need to agree with codonToAminoAcid().
+    """
+    def translate(seq):
+      return [lib_filter.codonToAminoAcid(c) for c in lib_filter.readCodons(seq)]
+    chars = 'ACGTNRYMHacgtnrymhX-'
+    for a in chars:
+      for b in chars:
+        for c in ['', a, a + b] + [a + b + x for x in chars]:
+          self.assertEqual(translate(c), lib_filter.codonsToAminoAcids(c))
+    rand = random.Random(0)
+    seqs = [''.join(rand.choice(chars) for i in xrange(rand.randint(0, 40)))
+            for j in xrange(200)]
+    for s, codes in zip(seqs, lib_filter.translateSequences(seqs)):
+      self.assertEqual(translate(s), [lib_filter.AMINO_ACIDS[x] for x in codes])
+      self.assertEqual(''.join(translate(s)), lib_filter.translateSequence(s))
+    self.assertEqual([], lib_filter.translateSequences([]))
+
+  def test_complement(self):
+    """ complement() and reverseComplement() need to handle both cases and gaps.
+    """
+    self.assertEqual('TGCAN-tgcan', lib_filter.complement('ACGTN-acgtn'))
+    self.assertEqual('ngca-NTGCA', lib_filter.reverseComplement('TGCAN-tgcn'))
+    self.assertEqual('', lib_filter.reverseComplement(''))
+    self.assertRaises(KeyError, lib_filter.complement, 'ACRT')
+
 
 class filterTests(unittest.TestCase):
   def test_uniquify_0(self):
@@ -2193,6 +3023,71 @@ class filterTests(unittest.TestCase):
     # cleanup
     self.addCleanup(removeDir, tmpDir)
 
+  def test_paralogs_0(self):
+    """ paralogs should count the OK and BAD other copies of each transcript,
+    and give the same labels when streaming name sorted input.
+    """
+    paralogs = imp.load_source(
+      'paralogs', os.path.join(
+        os.path.abspath(os.path.dirname(sys.argv[0])), 'paralogs'))
+    bedLines = [bedLine('chr%d' % i, 10, 40, name, 0, '+', 10, 40,
+                        '128,0,0', 1, '30', '0')
+                for i, name in enumerate(['a.1-0', 'a.1-1', 'b.1', 'a.1-2',
+                                          'c.1-0', 'c.1-1'])]
+    detailsLines = ['chr1 12 15 nonsense/a.1-1', 'chr5 12 15 noStop/c.1-1']
+
+    def labels(nameSorted):
+      transcripts = lib_filter.transcriptIterator(
+        iter([l + '\n' for l in bedLines]),
+        iter([l + '\n' for l in detailsLines]))
+      if nameSorted:
+        transcripts = sorted(transcripts, key=lambda t: t.name)
+      args = argparse.Namespace(nameSorted=nameSorted)
+      return dict(
+        (t.name, sorted(tuple(a.labels) for a in t.annotations
+                        if a.labels[0] in ('hasOkCopies', 'hasBadCopies')))
+        for t in paralogs.filterTranscripts(transcripts, args, None))
+
+    expected = {'a.1-0': [('hasBadCopies', 'count_1'),
+                          ('hasOkCopies', 'count_1')],
+                'a.1-1': [('hasOkCopies', 'count_2')],
+                'a.1-2': [('hasBadCopies', 'count_1'),
+                          ('hasOkCopies', 'count_1')],
+                'b.1': [],
+                'c.1-0': [('hasBadCopies', 'count_1')],
+                'c.1-1': [('hasOkCopies', 'count_1')],
+                }
+    self.assertEqual(labels(False), expected)
+    self.assertEqual(labels(True), expected)
+    # name sorted input must have the copies of a transcript together
+    transcripts = lib_filter.transcriptIterator(
+      iter([l + '\n' for l in bedLines]), iter([]))
+    self.assertRaises(RuntimeError, list, paralogs.filterTranscripts(
+        transcripts, argparse.Namespace(nameSorted=True), None))
+    # the copies of X.1 and X.11 stay apart when sorted as --nameSorted says
+    makeTempDirParent()
+    tmpDir = os.path.abspath(makeTempDir('paralogs_0'))
+    self.addCleanup(removeDir, tmpDir)
+    names = ['X.1-10', 'X.11-0', 'X.1-2', 'X.11-1', 'X.1-0']
+    bedFile = createBedFile(
+      [bedLine('chr%d' % i, 10, 40, name, 0, '+', 10, 40, '128,0,0', 1, '30',
+               '0') for i, name in enumerate(names)], 'names.bed', tmpDir)
+    env = dict(os.environ, LC_ALL='C')
+    sortedLines = subprocess.Popen(
+      ['sort', '-k4,4', bedFile], stdout=subprocess.PIPE,
+      env=env).communicate()[0].splitlines(True)
+    transcripts = lib_filter.transcriptIterator(iter(sortedLines), iter([]))
+    self.assertEqual(
+      dict((t.name, [tuple(a.labels) for a in t.annotations])
+           for t in paralogs.filterTranscripts(
+             transcripts, argparse.Namespace(nameSorted=True), None)),
+      {'X.1-0': [('hasOkCopies', 'count_2')],
+       'X.1-2': [('hasOkCopies', 'count_2')],
+       'X.1-10': [('hasOkCopies', 'count_2')],
+       'X.11-0': [('hasOkCopies', 'count_1')],
+       'X.11-1': [('hasOkCopies', 'count_1')],
+       })
+
   def test_indel_0(self):
     """indel should produce deletion annotations correctly."""
     makeTempDirParent()
@@ -2270,6 +3165,65 @@ class filterTests(unittest.TestCase):
 
     self.addCleanup(removeDir, tmpDir)
 
+  def test_metaFilter_inProcess(self):
+    """ metaFilter --inProcess should produce the same beds as running each
+    filter in its own process.
+    """
+    makeTempDirParent()
+    tmpDir = os.path.abspath(makeTempDir('metaFilter_inProcess'))
+    createMetaFilterInputs(tmpDir)
+    for outDir, extra in [('subprocess', []),
+                          ('inProcess', ['--inProcess',
+                                         '--writeIntermediates'])]:
+      os.mkdir(os.path.join(tmpDir, outDir))
+      runCommands([metaFilterCommand(outDir) + extra], tmpDir,
+                  errPipes=[True])
+    for name in ['out.bed', 'out_details.bed', 'out_clean.bed',
+                 'out_details_clean.bed',
+                 os.path.join('paralogs', 'out_details.bed')]:
+      with open(os.path.join(tmpDir, 'subprocess', name)) as f:
+        expected = f.read()
+      with open(os.path.join(tmpDir, 'inProcess', name)) as f:
+        self.assertEqual(f.read(), expected)
+    self.assertTrue('hasBadCopies' in expected)
+    self.addCleanup(removeDir, tmpDir)
+
+  def test_metaFilter_manifest(self):
+    """ metaFilter should skip the stages whose inputs have the same content
+    as in the last run, even if they were touched, and rerun them otherwise.
+    """
+    makeTempDirParent()
+    tmpDir = os.path.abspath(makeTempDir('metaFilter_manifest'))
+    createMetaFilterInputs(tmpDir)
+    os.mkdir(os.path.join(tmpDir, 'out'))
+    cmd = metaFilterCommand('out')
+    stages = ['uniquify', 'nonsense']
+
+    def stageTimes():
+      times = []
+      for stage in stages:
+        path = os.path.join(tmpDir, 'out', stage, 'out.bed')
+        times.append(os.stat(path).st_mtime)
+      return times
+    runCommands([cmd], tmpDir, errPipes=[True])
+    first = stageTimes()
+    time.sleep(1.1)
+    os.utime(os.path.join(tmpDir, 'in.bed'), None)
+    runCommands([cmd], tmpDir, errPipes=[True])
+    self.assertEqual(stageTimes(), first)
+    createSequenceFile({'test_0_nr': 'ATGATTAAGANNATGATTAAGT\n'}, tmpDir)
+    runCommands([cmd], tmpDir, errPipes=[True])
+    second = stageTimes()
+    for before, after in zip(first, second):
+      self.assertNotEqual(after, before)
+    # the stages also depend on metaFilter itself
+    self.assertTrue(('metaFilter', metaFilter.getBin('metaFilter')) in
+                    metaFilter.stageFiles(stages, 'in.bed', 'in_details.bed',
+                                          argparse.Namespace(**dict(
+                                            (name, None) for name in
+                                            metaFilter.SHARED_INPUTS))))
+    self.addCleanup(removeDir, tmpDir)
+
   def test_indel_1(self):
     """indel should produce insertion annotations correctly."""
     makeTempDirParent()
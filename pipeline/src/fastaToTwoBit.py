@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+"""
+fastaToTwoBit
+dent earl, dearl a soe ucsc edu
+
+Script to convert the --sequence / --refSequence fasta files used by the
+filters into the packed .2bit cache that lib_filter.getSequences() looks for
+(genome.fa -> genome.2bit). The cache is only used while it is newer than the
+fasta. Unlike kent's faToTwoBit this refuses to convert sequences containing
+IUPAC ambiguity codes rather than silently turning them into Ns.
+"""
+import sys
+import os
+sys.path.append(
+  os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(sys.argv[0]))), 'filters'))
+from argparse import ArgumentParser
+import lib_filter
+
+
+def initializeArguments(parser):
+  parser.add_argument('fastas', nargs='+', type=lib_filter.FileType,
+                      help='fasta file(s) to convert.')
+  parser.add_argument('--out', type=str,
+                      help='output .2bit file, only allowed with one fasta. '
+                      'default is the fasta path with a .2bit extension.')
+
+
+def checkArguments(args, parser):
+  if args.out is not None and len(args.fastas) != 1:
+    parser.error('--out may only be used with a single fasta')
+
+
+def main():
+  parser = ArgumentParser()
+  initializeArguments(parser)
+  args = parser.parse_args()
+  checkArguments(args, parser)
+  for fasta in args.fastas:
+    try:
+      out = lib_filter.fastaToTwoBit(fasta, args.out)
+    except lib_filter.TwoBitError as e:
+      sys.stderr.write('%s: %s\n' % (fasta, e))
+      sys.exit(1)
+    print '%s -> %s' % (fasta, out)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+"""
+metaFilterDriver
+dent earl, dearl a soe ucsc edu
+
+Script to run metaFilter (in process, see metaFilter --inProcess) on every
+genome of a release with a pool of worker processes. The reference inputs
+(--refSequence, --originalGeneCheckBed and --originalGeneCheckBedDetails),
+which are the same for every genome, are parsed once before the workers are
+forked and are shared with them copy-on-write rather than re-read by each.
+Inputs and outputs are laid out as the pipeline Makefile lays them out, i.e.
+the results for genome G are written to outDir/metaFilter.G/, along with the
+stats.xml and done files that the Makefile rule writes. As with metaFilter,
+genomes whose results are already up to date are not run again.
+"""
+from argparse import ArgumentParser, Namespace
+import imp
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+sys.path.append(
+  os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(sys.argv[0]))), 'filters'))
+sys.path.append(
+  os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(
+          os.path.abspath(sys.argv[0])))), 'lib'))  # to import lib_run
+import lib_filter
+import lib_run
+metaFilter = imp.load_source(
+  'metaFilter', os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(sys.argv[0]))),
+    'filters', 'metaFilter'))
+
+# the driver args and the reference FilterInputs, set by main() before the
+# workers are forked so that they are inherited rather than pickled.
+_driverArgs = None
+_reference = None
+
+
+def initializeArguments(parser):
+  parser.add_argument('--refGenome', type=str, default='C57B6J',
+                      help='default=%(default)s')
+  parser.add_argument('--genomes', nargs='+', type=str,
+                      help='genomes to run, i.e. $(genomes_1411)')
+  parser.add_argument('--geneCheckBeds', type=lib_filter.DirType,
+                      help='directory of GENOME.coding.gene-check.bed and '
+                      'GENOME.coding.gene-check-details.bed files')
+  parser.add_argument('--originalGeneCheckBed', type=lib_filter.FileType)
+  parser.add_argument('--originalGeneCheckBedDetails',
+                      type=lib_filter.FileType)
+  parser.add_argument('--alignmentDir', type=lib_filter.DirType,
+                      help='directory of GENOME.chained.psl files')
+  parser.add_argument('--sequenceDir', type=lib_filter.DirType,
+                      help='directory of GENOME.fa and GENOME.sizes files')
+  parser.add_argument('--refSequence', type=lib_filter.FileType,
+                      help='default=sequenceDir/refGenome.fa')
+  parser.add_argument('--mode', choices=['transmap', 'augustus'])
+  parser.add_argument('--outDir', type=lib_filter.DirType,
+                      help='location of the metaFilter.GENOME directories')
+  parser.add_argument('--workers', type=int, default=None,
+                      help='number of genomes to run at once. '
+                      'default=number of cpus')
+  parser.add_argument('--memoDb', type=os.path.abspath, default=None,
+                      help='sqlite database of per-transcript filter results '
+                      'shared by the genomes and reused across releases. '
+                      'default=%(default)s')
+  parser.add_argument('--writeIntermediates', action='store_true',
+                      default=False,
+                      help='write the beds of each filter, for debugging. '
+                      'default=%(default)s')
+  parser.add_argument('--sortedInput', action='store_true', default=False,
+                      help='the gene-check beds are sorted by chromosome, '
+                      'see metaFilter --sortedInput. default=%(default)s')
+
+
+def checkArguments(args, parser):
+  # setting
+  pairs = tuple((item, getattr(args, item)) for item in
+                ['genomes', 'geneCheckBeds', 'originalGeneCheckBed',
+                 'originalGeneCheckBedDetails', 'alignmentDir',
+                 'sequenceDir', 'outDir'])
+  for name, value in pairs:
+    if value is None:
+      parser.error('Specify --%s' % name)
+  if args.refSequence is None:
+    args.refSequence = lib_filter.FileType(
+      os.path.join(args.sequenceDir, '%s.fa' % args.refGenome))
+  if args.workers is None:
+    args.workers = multiprocessing.cpu_count()
+  if args.workers < 1:
+    parser.error('--workers must be at least 1')
+
+
+def genomeArgs(args, genome):
+  """ Return the metaFilter args for GENOME, laid out as in the Makefile.
+  """
+  outDir = os.path.join(args.outDir, 'metaFilter.%s' % genome)
+  result = Namespace(
+    refGenome=args.refGenome,
+    genome=genome,
+    geneCheckBed=lib_filter.FileType(os.path.join(
+        args.geneCheckBeds, '%s.coding.gene-check.bed' % genome)),
+    geneCheckBedDetails=lib_filter.FileType(os.path.join(
+        args.geneCheckBeds, '%s.coding.gene-check-details.bed' % genome)),
+    originalGeneCheckBed=args.originalGeneCheckBed,
+    originalGeneCheckBedDetails=args.originalGeneCheckBedDetails,
+    alignment=lib_filter.FileType(os.path.join(
+        args.alignmentDir, '%s.chained.psl' % genome)),
+    sequence=lib_filter.FileType(os.path.join(
+        args.sequenceDir, '%s.fa' % genome)),
+    refSequence=args.refSequence,
+    chromSizes=lib_filter.FileType(os.path.join(
+        args.sequenceDir, '%s.sizes' % genome)),
+    outDir=outDir,
+    mode=args.mode,
+    inProcess=True,
+    memoDb=args.memoDb,
+    sortedInput=args.sortedInput,
+    workers=1,  # pool workers can not have workers of their own
+    writeIntermediates=args.writeIntermediates)
+  if not os.path.exists(outDir):
+    os.mkdir(outDir)
+  return result
+
+
+def loadReference(args):
+  """ Parse the reference inputs shared by every genome, returning a
+  lib_filter.FilterInputs holding them.
+  """
+  reference = lib_filter.FilterInputs(args)
+  reference.getRefSequences()
+  reference.getOriginalTranscriptsDict()
+  return reference
+
+
+def writeStats(outDir):
+  """ Write the stats.xml of the results in OUTDIR, as the Makefile does.
+  """
+  stats = os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])),
+                       'geneCheckStatCreator.py')
+  cmd = [stats,
+         '--geneCheck', os.path.join(outDir, 'out.bed'),
+         '--geneCheckDetails', os.path.join(outDir, 'out_details.bed'),
+         '--out', os.path.join(outDir, 'stats.xml')]
+  lib_run.RunCommandsSerial([cmd], outDir,
+                            out_pipes=[os.path.join(outDir, 'stats.out')])
+
+
+def runGenome(genome):
+  """ Run metaFilter on GENOME, then write its stats.xml and done files.
+  Returns (genome, seconds, ran, error) where ran is False if the results
+  were already up to date and error is None or the traceback of the failure.
+  """
+  t0 = time.time()
+  ran = False
+  try:
+    args = genomeArgs(_driverArgs, genome)
+    filters = metaFilter.getFilters()
+    inputs, locations = metaFilter.getInputsAndLocations(args, filters)
+    shared = lib_filter.FilterInputs(args)
+    shared.shareReference(_reference)
+    ran = metaFilter.runStages(args, filters, inputs, locations, shared)
+    done = os.path.join(args.outDir, 'done')
+    if ran or not os.path.exists(done):
+      writeStats(args.outDir)
+      lib_run.Touch(done)
+  except Exception:
+    return genome, time.time() - t0, ran, traceback.format_exc()
+  return genome, time.time() - t0, ran, None
+
+
+def main():
+  global _driverArgs, _reference
+  parser = ArgumentParser()
+  initializeArguments(parser)
+  args = parser.parse_args()
+  checkArguments(args, parser)
+  t0 = time.time()
+  _driverArgs = args
+  _reference = loadReference(args)
+  print 'loaded reference inputs in %.1f s' % (time.time() - t0)
+  sys.stdout.flush()
+  # a fresh fork per genome returns each genome's memory when it finishes
+  pool = multiprocessing.Pool(min(args.workers, len(args.genomes)),
+                              maxtasksperchild=1)
+  failed = []
+  try:
+    for i, (genome, seconds, ran, error) in enumerate(
+        pool.imap_unordered(runGenome, args.genomes), 1):
+      if error is not None:
+        failed.append(genome)
+        print '[%d/%d] %s FAILED after %.1f s\n%s' % (
+          i, len(args.genomes), genome, seconds, error)
+      elif ran:
+        print '[%d/%d] %s done in %.1f s' % (
+          i, len(args.genomes), genome, seconds)
+      else:
+        print '[%d/%d] %s already up to date' % (i, len(args.genomes), genome)
+      sys.stdout.flush()
+  finally:
+    pool.close()
+    pool.join()
+  print '%d genomes in %.1f s' % (len(args.genomes), time.time() - t0)
+  if failed:
+    sys.stderr.write('failed genomes: %s\n' % ' '.join(failed))
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
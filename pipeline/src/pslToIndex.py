@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+"""
+pslToIndex
+dent earl, dearl a soe ucsc edu
+
+Script to save the --alignment psl files used by the filters as the
+lib_filter.AlignmentIndex that lib_filter.getAlignmentIndex() looks for
+(genome.chained.psl -> genome.chained.psl.npz), which loads far faster than
+the psl parses. The index is only used while it is newer than the psl.
+"""
+import sys
+import os
+sys.path.append(
+  os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(sys.argv[0]))), 'filters'))
+from argparse import ArgumentParser
+import lib_filter
+
+
+def initializeArguments(parser):
+  parser.add_argument('psls', nargs='+', type=lib_filter.FileType,
+                      help='psl file(s) to index.')
+  parser.add_argument('--out', type=str,
+                      help='output .npz file, only allowed with one psl. '
+                      'default is the psl path with a .psl.npz extension.')
+
+
+def checkArguments(args, parser):
+  if args.out is not None and len(args.psls) != 1:
+    parser.error('--out may only be used with a single psl')
+
+
+def main():
+  parser = ArgumentParser()
+  initializeArguments(parser)
+  args = parser.parse_args()
+  checkArguments(args, parser)
+  for psl in args.psls:
+    out = lib_filter.pslToIndex(psl, args.out)
+    print '%s -> %s' % (psl, out)
+
+
+if __name__ == '__main__':
+  main()